@@ -1,9 +1,59 @@
 # some config stuff for server/client
+import os
 
 SERVER_IP = "192.168.1.126"
 TCP_PORT = 8888
 BUFFER_SIZE = 1024
 
+# "mraa" for the Edison's mraa/upm libraries, "sim" for sim_hardware.py
+HW_BACKEND = os.environ.get("EDISON_HW_BACKEND", "mraa")
+
+# background sensor sampler (edison_client)
+SAMPLE_RATE_HZ = 10.0      # polls per second, per sensor
+SAMPLE_MAX_AGE = 0.5       # seconds a cached reading stays valid for a reply
+
+# sensor subscription streams (edison_client)
+SUB_MAX_RATE_HZ = 100.0    # fastest allowed subscription rate
+SUB_BATCH_INTERVAL = 0.25  # seconds a pushed sample may wait in a batch
+SUB_BATCH_SIZE = 32        # samples per push line before flushing early
+
+# sound level engine (edison_client)
+SOUND_RATE_HZ = 2000.0     # average ADC samples per second
+SOUND_BURST = 50           # samples read back to back per burst
+SOUND_WINDOW = 0.1         # seconds of samples per level window
+SOUND_HISTORY = 50         # windows of levels kept
+SOUND_FULL_SCALE = 512.0   # ADC counts of a full-scale swing (10-bit ADC), 0 dB
+SOUND_DB_FLOOR = -90.0     # dB reported for silence
+
+# LCD update scheduler (edison_client)
+LCD_REFRESH_HZ = 10.0      # maximum I2C panel updates per second
+
+# server outbound command queues (sensor_server)
+MAX_IN_FLIGHT = 2              # commands sent to a client but not yet answered
+REPLY_TIMEOUT = 5.0            # seconds an unanswered command holds its slot before it fails
+COMMAND_TAG = "#"              # queued commands go out as "#<id> <cmd>", the reply echoes "#<id> "
+DEFAULT_DEVICE_RATE_HZ = None  # max commands per second to one device, None = no cap
+DEVICE_MAX_RATE_HZ = {         # per-device overrides
+    "redLED": 50.0,
+    "greenLED": 50.0,
+    "blueLED": 50.0,
+    "lcd": 10.0,
+}
+
+# server metrics (sensor_server)
+STATS_PORT = 8889              # local JSON stats socket on 127.0.0.1, None = off
+STATS_DUMP_PATH = os.environ.get("SENSOR_STATS_PATH")  # periodic JSON dump file
+STATS_DUMP_INTERVAL = 10.0     # seconds between dumps
+
+# sensor reading log (sensor_server), see sensor_log.py
+SENSOR_LOG_DIR = os.environ.get("SENSOR_LOG_DIR")  # log directory, None = off
+LOG_SEGMENT_RECORDS = 65536    # records per segment file (16 bytes each)
+LOG_SEGMENT_SECONDS = 3600.0   # longest time span of one segment
+LOG_INDEX_EVERY = 256          # records between segment time index entries
+LOG_FLUSH_INTERVAL = 1.0       # seconds between writes of held readings
+LOG_REORDER_WINDOW = 1.0       # seconds a reading is held so late pushes can still be written in order
+
 def clamp(n, lower, upper):
 
     return min(max(float(n), float(lower)), float(upper))
+
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#       device_registry.py: Device-name routing index for sensor_server
+#               Each connected client (board) announces its devices on
+#               connect; the registry maps device name -> owning boards so
+#               commands go only to boards that own the device
+#               Boards are named board1, board2, ... and can be addressed
+#               directly, i.e. "board2.redLED ON 50"
+#
+
+BOARD_SEP = "."
+
+
+class DeviceRegistry(object):
+    """
+    DeviceRegistry: Indexes connected boards by name and by device
+    A board that reconnects from the same IP gets its old name back, as
+    long as that name is not in use by another connection
+
+    Example usage: registry.add(conn, addr, ["redLED", "temp"])
+    """
+
+    def __init__(self):
+        self.boards = {}        # board name -> conn
+        self.names = {}         # conn -> board name
+        self.addrs = {}         # conn -> (ip, port)
+        self.owned = {}         # conn -> list of device names
+        self.devices = {}       # device name -> set of conns
+
+        # ip -> board names handed out to it, for reconnects
+        self.known = {}
+        self._next_id = 1
+
+    def add(self, conn, addr, device_names):
+        """
+        add: Registers a newly connected board and the devices it owns
+
+        @param conn: (socket obj) client TCP socket object
+        @param addr: (tuple) client (ip, port)
+        @param device_names: (list) devices announced by the client
+        @return name: (str) board name assigned to the client
+        """
+        name = None
+        for old in self.known.get(addr[0], []):
+            if old not in self.boards:
+                name = old
+                break
+
+        if name is None:
+            name = "board%d" % (self._next_id)
+            self._next_id += 1
+            self.known.setdefault(addr[0], []).append(name)
+
+        self.boards[name] = conn
+        self.names[conn] = name
+        self.addrs[conn] = addr
+        self.owned[conn] = list(device_names)
+        for dev in device_names:
+            self.devices.setdefault(dev, set()).add(conn)
+
+        return name
+
+    def remove(self, conn):
+        """
+        remove: Drops a disconnected board from every index
+
+        @param conn: (socket obj) client TCP socket object
+        @return name: (str) board name the client had, None if unknown
+        """
+        name = self.names.pop(conn, None)
+        if name is None:
+            return None
+
+        del self.boards[name]
+        del self.addrs[conn]
+        for dev in self.owned.pop(conn):
+            owners = self.devices[dev]
+            owners.discard(conn)
+            if not owners:
+                del self.devices[dev]
+
+        return name
+
+    def route(self, target):
+        """
+        route: Looks up the boards a command for target should go to
+
+        @param target: (str) device name, or board.device for a single board
+        @return conns: (list) client sockets that own the device
+        @return device: (str) device name with any board prefix removed
+
+        Example usage: route("board2.redLED") -> ([board2_conn], "redLED")
+        """
+        if BOARD_SEP in target:
+            board, device = target.split(BOARD_SEP, 1)
+            conn = self.boards.get(board)
+            if conn is None or device not in self.owned[conn]:
+                return [], device
+            return [conn], device
+
+        return list(self.devices.get(target, ())), target
+
+    def label(self, conn):
+        """
+        label: Name used for a client in server output, i.e. board2@10.0.0.5
+        """
+        return "%s@%s" % (self.names.get(conn, "?"),
+                self.addrs.get(conn, ("?",))[0])
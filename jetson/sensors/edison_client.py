@@ -1,6 +1,7 @@
 #!/usr/bin/python
 #       sensor_client.py: client-side program to run on Intel Edison dev board
 #               This program creates a TCP socket connection with SERVER_IP @ port TCP_PORT
+#               (or the host/port given on the command line)
 #				New commands are received, parsed, and distributed within respective HW
 #				Primary HW calls (mraa/upm) are defined in edison_sensors.py
 #
@@ -9,8 +10,22 @@
 import socket
 import signal
 import sys
+import threading
 from config import *
 from edison_sensors import *
+from lcd_scheduler import LcdScheduler
+from sensor_sampler import SensorSampler
+from sound_sampler import SoundSampler
+from subscriptions import SubscriptionManager
+
+
+SUB_COMMANDS = ["sub", "unsub"]
+
+# "sound <level>" picks a level from the sound engine, see SoundSampler.get
+SOUND_LEVELS = {"rms": 1, "peak": 2, "db": 3}
+
+# replies (main thread) and pushes (subscription thread) share the socket
+send_lock = threading.Lock()
 
 
 # declaration for SIGINT signal handler error
@@ -61,17 +76,54 @@ def parse_command(cmd):
     return obj, action, opt
 
 
-def exec_command(deviceList, obj, action, opt):
+def exec_subscription(subs, cmd, name, opt):
+    """
+    exec_subscription: Handles the sub/unsub commands for sensor streams
+    sub takes a sensor name, a rate in Hz, and either "db <deadband>" or
+    "th <threshold>"; matching samples are then pushed by subs
+
+    @param subs: (SubscriptionManager) client subscription streams
+    @param cmd: (str) "sub" or "unsub"
+    @param name: (str) sensor name, i.e. temp
+    @param opt: (list) rate, mode, and level strings for sub
+    @return ret_msg: (str) confirm or error msg sent back to server
+
+    Example usage: exec_subscription(subs, "sub", "temp", ["2", "db", "0.5"])
+    """
+    if name is None:
+        return "!err: %s needs a sensor name" % (cmd)
+
+    if cmd == "unsub":
+        subs.unsubscribe(name)
+        return name + " unsubscribed"
+
+    try:
+        rate, mode, level = opt
+        subs.subscribe(name, float(rate), mode.lower(), float(level))
+
+    except (TypeError, ValueError) as e:
+        return "!err: sub %s: %s" % (name, e)
+
+    return name + " subscribed"
+
+
+def exec_command(deviceList, obj, action, opt, sampler=None, sound=None):
     """
     exec_command: Uses result of parse_command to perform respective I/O
     commands on obj. Explicitly looks for LEDs or sensors listed in deviceList
     Calls led_action if obj is an LED, or get_grove_value if obj is a sensor
+    Sensor reads are served from sampler's cache when a sampler is given, an
+    optional action sets the freshness bound in ms, i.e. "temp 200"
+    With a sound engine, "sound rms", "sound peak", and "sound db" return
+    that level of the latest window, named i.e. "sound_rms: 38.771"
     Checks if the original command also contains a exit/quit sequence
 
     @param deviceList: (dict) sensor name(key): sensor obj (value)
     @param obj: (str) the name of the sensor object, i.e. blueLED
     @param action: (str) the action to perform on sensor object, i.e. ON/OFF
     @param opt: (str) add'l options or arguments for action, i.e. PWM value
+    @param sampler: (SensorSampler) defaults None, background sensor cache
+    @param sound: (SoundSampler) defaults None, sound level engine
     @return ret_msg: (str) confirm msg if LED obj, or sensor read value
 
     Example usage: exec_command(deviceDictionary, "blueLED", "ON", "45")
@@ -85,10 +137,12 @@ def exec_command(deviceList, obj, action, opt):
         return None
 
     print obj, action, opt
-    
-    # list comprehension, parses for read-only sensors
-    sensors_only = [s for s in deviceList if (s[-3:] != "LED") and \
-            (s != "lcd") and (s != "buzz")]
+
+    # read-only sensors, the sampler already holds the filtered list
+    if sampler is not None:
+        sensors_only = sampler.sensor_names
+    else:
+        sensors_only = get_sensor_names(deviceList)
 
     # retrieves sensor obj from io_setup() in dictionary
     device_obj = deviceList[obj]
@@ -127,10 +181,38 @@ def exec_command(deviceList, obj, action, opt):
         return ret_msg
 
     # read from sensor obj
-    elif obj in sensors_only:       
-        sensor_val = get_grove_value(device_obj)
+    elif obj in sensors_only:
+        if sound is not None and obj == "sound" and action is not None and \
+                action.lower() in SOUND_LEVELS:
+            levels = sound.get()
+            if levels is None:
+                return "!err: sound: no level yet"
+
+            sensor_val = levels[SOUND_LEVELS[action.lower()]]
+
+            # its own name, so levels can be told apart from plain dB reads
+            obj = "sound_" + action.lower()
+
+        elif sampler is None:
+            sensor_val = get_grove_value(device_obj)
+
+        else:
+            # optional freshness bound in ms, i.e. "temp 200"
+            max_age = SAMPLE_MAX_AGE
+            try:
+                if action is not None:
+                    max_age = float(action) / 1000.0
+
+            except ValueError:
+                pass
+
+            sensor_val, _ = sampler.get(obj, max_age)
+
+        if sensor_val is None:
+            return "!err: %s: no reading yet" % (obj)
+
         ret_msg = str("{}: {:.3f}".format(obj, sensor_val))
-        lcd_action(deviceList["lcd"], "c", None)
+        # lcd write already clears the display
         lcd_action(deviceList["lcd"], "w", ret_msg)
         return ret_msg
 
@@ -173,11 +255,25 @@ def connect_server(host, port, device_dict):
     print "Connection to server established: %s, %s" % (host, port)
 
     # sends device list to server to tell user what devices can be commanded
-    sock.send(" ".join(device_dict.keys()))
+    send_line(sock, " ".join(device_dict.keys()))
 
     return sock
 
 
+def send_line(sock, msg):
+    """
+    send_line: Sends one newline-terminated message to the server
+    Safe to call from the subscription thread and the main loop at once
+
+    @param sock: (socket) socket connection object from connect_server
+    @param msg: (str) reply or push line, without the trailing newline
+
+    Example usage: send_line(sock, "blueLED cmd succ")
+    """
+    with send_lock:
+        sock.sendall(msg + "\n")
+
+
 
 def close_client(sock_conn, display):
     """
@@ -185,7 +281,7 @@ def close_client(sock_conn, display):
     shutdown and disconnect from socket, also turns off LCD
 
     @param sock_conn: (socket) socket connection object from socket.socket call
-    @param display: (LCD obj) LCD display variable to clear, turn off, etc
+    @param display: (LcdScheduler) LCD display variable to clear, turn off, etc
 
     Example usage: close_client(sock, lcd)
     """
@@ -194,6 +290,7 @@ def close_client(sock_conn, display):
     sock_conn.close()
 
     display.clear()
+    display.stop()
     display.backlightOff()
     display.displayOff()
     print "done\n"
@@ -208,40 +305,89 @@ if __name__ == '__main__':
    # primary device list dictionary
     devices = io_setup()
 
-    sock = connect_server(SERVER_IP, TCP_PORT, devices)
+    # LCD commands go to a framebuffer, only changes are written over I2C
+    devices["lcd"] = LcdScheduler(devices["lcd"]).start()
+
+    # sound levels come from their own burst sampler, sound reads through
+    # the sensor sampler just pick up its latest window
+    sound = SoundSampler(devices["sound"]).start()
+    set_sound_engine(sound)
+
+    # sensor replies are served from the sampler's cache
+    sampler = SensorSampler(devices, get_sensor_names(devices)).start()
+
+    # optional host/port override, i.e. edison_client.py 127.0.0.1 8888
+    host = sys.argv[1] if len(sys.argv) > 1 else SERVER_IP
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else TCP_PORT
 
+    sock = connect_server(host, port, devices)
+
+    # sensor streams, pushes go out on the same socket as replies
+    subs = SubscriptionManager(sampler, lambda line: send_line(sock, line))
+    subs.start()
+
+    recv_buf = ""
     while True:
         data = sock.recv(BUFFER_SIZE)
         
         if not data:
             break
-        
-        else:
+
+        # commands are newline-delimited, one recv may carry several
+        # commands or end partway through one
+        recv_buf += data
+        lines = recv_buf.split("\n")
+        recv_buf = lines.pop()
+
+        for data in lines:
+            if not data:
+                continue
+
             print "command recv'd: ", data
-            
+
+            # echo the server's command id, i.e. "#12 temp", on the reply
+            tag = ""
+            if data.startswith(COMMAND_TAG):
+                tag, _, data = data.partition(" ")
+                tag += " "
+
             try:
                 # "blueLED" "ON" 45
                 entity, action, option = parse_command(data)
 
-                if entity not in devices.keys():
+                if entity in SUB_COMMANDS:
+                    send_line(sock, tag + exec_subscription(subs, entity,
+                            action, option))
+                    continue
+
+                # exit/quit sequences are handled by exec_command
+                if entity not in devices.keys() and \
+                        entity.lower() not in ["exit", "q", "quit"]:
                     raise InvalidDeviceError
 
-                client_ret = exec_command(devices, entity, action, option)
+                client_ret = exec_command(devices, entity, action, option,
+                        sampler, sound)
 
                 if client_ret is None:
                     raise CloseError
 
                 else:
-                    sock.send(client_ret)
+                    send_line(sock, tag + client_ret)
 
             except CloseError:
+                subs.stop()
+                sampler.stop()
+                sound.stop()
                 close_client(sock, devices["lcd"])
                 sys.exit()
 
             except InvalidDeviceError:
-                sock.send("!err: invalid device command")
+                send_line(sock, tag + "!err: invalid device command")
                 continue
 
 
+    subs.stop()
+    sampler.stop()
+    sound.stop()
     close_client(sock, devices["lcd"])
 
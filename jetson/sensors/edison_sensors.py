@@ -7,11 +7,18 @@
 #       Author: Dylan Wong
 #
 
-import mraa
-from upm import pyupm_grove as grove
-from upm import pyupm_jhd1313m1 as groveLCD
-from upm import pyupm_buzzer as groveBuzzer
 from config import *
+from sound_sampler import sound_levels
+
+# hardware backend, EDISON_HW_BACKEND=sim runs without an Edison
+if HW_BACKEND == "sim":
+    from sim_hardware import mraa, grove, groveLCD, groveBuzzer
+
+else:
+    import mraa
+    from upm import pyupm_grove as grove
+    from upm import pyupm_jhd1313m1 as groveLCD
+    from upm import pyupm_buzzer as groveBuzzer
 
 
 ROT_PIN = 1
@@ -26,6 +33,9 @@ BUZZ_PIN = 9
 PWM_PINS = [3, 5, 6, 9, 10, 11]
 PWM_PER = 500
 
+# SoundSampler serving sound reads, see set_sound_engine
+sound_engine = None
+
 
 def io_setup():
     """
@@ -91,6 +101,33 @@ def io_setup():
     return devices
 
 
+def set_sound_engine(engine):
+    """
+    set_sound_engine: Makes get_grove_value serve sound reads from a running
+    SoundSampler instead of reading the ADC itself
+
+    @param engine: (SoundSampler) sound level engine, None to read directly
+
+    Example usage: set_sound_engine(SoundSampler(devices["sound"]).start())
+    """
+    global sound_engine
+    sound_engine = engine
+
+
+def get_sensor_names(device_dict):
+    """
+    get_sensor_names: Filters the device dictionary for read-only sensors,
+    i.e. everything that is not an LED, the LCD, or the buzzer
+
+    @param device_dict: (dict) sensor name(key): sensor obj (value)
+    @return sensor_names: (list) names of read-only sensors
+
+    Example usage: get_sensor_names(io_setup())
+    """
+    return [s for s in device_dict if (s[-3:] != "LED") and \
+            (s != "lcd") and (s != "buzz")]
+
+
 def led_action(led, state, pwm=None):
     """
     led_action: Calls PWM write to LED pin with duty cycle (0.0f to 1.0f)
@@ -113,10 +150,12 @@ def led_action(led, state, pwm=None):
 def get_grove_value(sensor):
     """
     get_grove_value: Reads from sensor with upm lib and converts to human-
-    readable unit; rotary_enc=degrees, temp=Fahrenheit, light=lux
+    readable unit; rotary_enc=degrees, temp=Fahrenheit, light=lux,
+    sound=dB (relative to a full-scale ADC swing)
 
     @param sensor: (Grove obj) sensor object from device list
-    @return sensor_read: (float) corresponding converted sensor reading
+    @return sensor_read: (float) corresponding converted sensor reading,
+                None for sound before the sound engine's first window
 
     Example usage: get_grove_value(light_sensor)
     """
@@ -150,6 +189,22 @@ def get_grove_value(sensor):
 
         sensor_read = float(light_lux)
 
+    # sound sensor, level of the latest window in dB
+    elif sensor == sound_sensor:
+        if sound_engine is not None:
+            # the engine's thread owns the ADC, never read it from here
+            levels = sound_engine.get()
+            if levels is None:
+                return None
+
+        else:
+            # no engine, take one short burst
+            burst = [sensor.read() for _ in range(SOUND_BURST)]
+            levels = (None,) + tuple(l[0] for l in
+                    sound_levels(burst, SOUND_BURST))
+
+        sensor_read = float(levels[3])
+
     return sensor_read
 
 
@@ -240,10 +295,10 @@ def buzz_action(buzz, cmd, val):
         except ValueError:
             if sound.lower() in chords.keys():
                 freq = chords[sound]
-			
-			else:
-				buzz_ret = "buzz: invalid tone"
-				return buzz_ret
+
+            else:
+                buzz_ret = "buzz: invalid tone"
+                return buzz_ret
     
         buzz_ret = "buzz played %s for %d us" % (sound, duration_us)
         buzz.playSound(freq, duration_us)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#       lcd_scheduler.py: Coalescing update scheduler for the JHD1313M1 LCD
+#               Commands write into a 2x16 framebuffer; a background thread
+#               diffs it against what is on the panel and sends only the
+#               changed characters (and color) over I2C, at a capped rate
+#
+
+import threading
+import time
+
+from config import *
+
+LCD_ROWS = 2
+LCD_COLS = 16
+
+# unchanged chars between two changed runs that are cheaper to rewrite
+# than to skip with another setCursor command
+LCD_MERGE_GAP = 2
+
+
+class LcdScheduler(object):
+    """
+    LcdScheduler: Stand-in for the upm Jhd1313m1 object used by lcd_action
+    clear/home/setCursor/write/setColor only update the framebuffer and
+    return immediately; any other Jhd1313m1 call is flushed and forwarded
+    to the panel
+
+    Example usage: devices["lcd"] = LcdScheduler(devices["lcd"]).start()
+    """
+
+    def __init__(self, display, refresh_hz=LCD_REFRESH_HZ):
+        """
+        @param display: (LCD obj) JHD1313M1 display from io_setup
+        @param refresh_hz: (float) maximum panel updates per second
+        """
+        self.display = display
+        self.period = 1.0 / refresh_hz
+
+        # desired content, guarded by _lock
+        self.rows = [[" "] * LCD_COLS for r in range(LCD_ROWS)]
+        self.cursor = [0, 0]
+        self.color = None
+
+        # what is on the panel, None until the first flush
+        self.panel_rows = None
+        self.panel_color = None
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def clear(self):
+        with self._lock:
+            self.rows = [[" "] * LCD_COLS for r in range(LCD_ROWS)]
+            self.cursor = [0, 0]
+        self._dirty.set()
+
+    def home(self):
+        with self._lock:
+            self.cursor = [0, 0]
+
+    def setCursor(self, row, col):
+        with self._lock:
+            self.cursor = [row, col]
+
+    def write(self, msg):
+        """
+        write: Writes msg at the cursor, clipped to the end of the row
+        """
+        with self._lock:
+            row, col = self.cursor
+            if 0 <= row < LCD_ROWS:
+                for c in msg[:max(LCD_COLS - col, 0)]:
+                    self.rows[row][col] = c
+                    col += 1
+            self.cursor = [row, col]
+        self._dirty.set()
+
+    def setColor(self, r, g, b):
+        with self._lock:
+            self.color = (int(r), int(g), int(b))
+        self._dirty.set()
+
+    def __getattr__(self, name):
+        # backlightOff, displayOff, etc: bring the panel up to date, then
+        # call straight through
+        attr = getattr(self.display, name)
+        if not callable(attr):
+            return attr
+
+        def passthrough(*args):
+            self.flush()
+            with self._io_lock:
+                return attr(*args)
+
+        return passthrough
+
+    def flush(self):
+        """
+        flush: Sends the framebuffer/panel differences to the display now
+        """
+        with self._lock:
+            rows = [list(r) for r in self.rows]
+            color = self.color
+            self._dirty.clear()
+
+        with self._io_lock:
+            if color is not None and color != self.panel_color:
+                self.display.setColor(*color)
+                self.panel_color = color
+
+            for r in range(LCD_ROWS):
+                old = self.panel_rows[r] if self.panel_rows else None
+                for col, text in diff_runs(old, rows[r]):
+                    self.display.setCursor(r, col)
+                    self.display.write(text)
+
+            self.panel_rows = rows
+
+    def start(self):
+        """
+        start: Starts the refresh thread
+
+        @return self: (LcdScheduler) for chaining
+        """
+        if self._thread is not None:
+            return self
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stop: Stops the refresh thread after a final flush
+        """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._dirty.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            if self._stop.is_set():
+                break
+
+            start = time.time()
+            try:
+                self.flush()
+
+            except Exception as e:
+                print "[LCD] update failed: %s" % (e)
+
+            # refresh rate cap, later writes coalesce into the next flush
+            self._stop.wait(max(self.period - (time.time() - start), 0))
+
+
+def diff_runs(old, new):
+    """
+    diff_runs: Finds the runs of characters that differ between two rows
+
+    @param old: (list) chars on the panel, None if unknown
+    @param new: (list) desired chars
+    @return runs: (list) (column, text) tuples to write
+
+    Example usage: diff_runs(list("temp: 71.000    "), list("temp: 71.500    "))
+    """
+    if old is None:
+        return [(0, "".join(new))]
+
+    runs = []
+    start = None
+    end = None
+    for col in range(len(new)):
+        if old[col] == new[col]:
+            continue
+
+        if start is not None and col - end - 1 > LCD_MERGE_GAP:
+            runs.append((start, "".join(new[start:end + 1])))
+            start = None
+
+        if start is None:
+            start = col
+        end = col
+
+    if start is not None:
+        runs.append((start, "".join(new[start:end + 1])))
+
+    return runs
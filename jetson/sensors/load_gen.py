@@ -0,0 +1,182 @@
+#!/usr/bin/python
+#       load_gen.py: Load generator for the sensor server/client stack
+#               Starts sensor_server.py and N edison_client.py processes on
+#               the simulated hardware backend, then drives commands through
+#               the server's stdin and times each client reply
+#               Reports round-trip latency percentiles and throughput
+#
+#       Example usage: python load_gen.py -n 8 -c 500 --cmd "temp 0"
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from config import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(sorted_vals, pct):
+    """
+    percentile: Nearest-rank percentile of an already sorted list
+
+    @param sorted_vals: (list) sorted numbers
+    @param pct: (float) 0 - 100
+    @return (float) value at pct
+    """
+    if not sorted_vals:
+        return float("nan")
+
+    rank = int(round(pct / 100.0 * (len(sorted_vals) - 1)))
+    return sorted_vals[rank]
+
+
+def pump_lines(stream, line_queue):
+    """
+    pump_lines: Reader thread body, moves lines from a process pipe into
+    a queue so the main thread can wait on them with a timeout
+    """
+    for line in iter(stream.readline, ""):
+        line_queue.put((time.time(), line.rstrip("\n")))
+
+
+def wait_for(line_queue, match, count, timeout):
+    """
+    wait_for: Collects arrival times of the next count lines that satisfy match
+
+    @param line_queue: (Queue) (arrival time, line) tuples from pump_lines
+    @param match: (function) predicate on a line
+    @param count: (int) number of matching lines to wait for
+    @param timeout: (float) seconds to wait in total
+    @return arrivals: (list) arrival times, shorter than count on timeout
+    """
+    arrivals = []
+    deadline = time.time() + timeout
+
+    while len(arrivals) < count:
+        try:
+            stamp, line = line_queue.get(timeout=max(deadline - time.time(), 0))
+
+        except Empty:
+            break
+
+        if match(line):
+            arrivals.append(stamp)
+
+    return arrivals
+
+
+def is_reply(line):
+    return line.startswith("[CLIENT") and "Available sensors" not in line
+
+
+def start_clients(num_clients, host, port, latency, python=sys.executable):
+    """
+    start_clients: Launches edison_client.py processes on the sim backend
+
+    @param num_clients: (int) number of clients
+    @param host: (str) server address
+    @param port: (int) server port
+    @param latency: (str) SIM_LATENCY setting, None for the defaults
+    @param python: (str) defaults sys.executable, interpreter to run the
+                clients with (they are Python 2 only)
+    @return procs: (list) client Popen objects
+    """
+    env = dict(os.environ, EDISON_HW_BACKEND="sim")
+    if latency:
+        env["SIM_LATENCY"] = latency
+
+    devnull = open(os.devnull, "w")
+    return [subprocess.Popen([python, "edison_client.py", host,
+                str(port)], cwd=HERE, env=env, stdout=devnull, stderr=devnull)
+            for i in range(num_clients)]
+
+
+def run(args):
+    server = subprocess.Popen([sys.executable, "-u", "sensor_server.py",
+            args.host, str(args.port)], cwd=HERE, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+
+    lines = Queue()
+    reader = threading.Thread(target=pump_lines, args=(server.stdout, lines))
+    reader.daemon = True
+    reader.start()
+
+    wait_for(lines, lambda l: l.startswith("[SERVER] Max"), 1, 5.0)
+    # bind/listen happens right after the startup banner
+    time.sleep(0.2)
+
+    clients = start_clients(args.clients, args.host, args.port, args.latency,
+            args.python)
+    joined = wait_for(lines, lambda l: "Available sensors" in l,
+            args.clients, 10.0)
+    if len(joined) < args.clients:
+        print("only %d/%d clients connected" % (len(joined), args.clients))
+
+    rtts = []
+    timeouts = 0
+    start = time.time()
+
+    for i in range(args.count):
+        sent = time.time()
+        server.stdin.write(args.cmd + "\n")
+        server.stdin.flush()
+
+        arrivals = wait_for(lines, is_reply, len(joined), args.timeout)
+        timeouts += len(joined) - len(arrivals)
+        rtts.extend(t - sent for t in arrivals)
+
+    elapsed = time.time() - start
+
+    server.stdin.write("quit\n")
+    server.stdin.flush()
+    # give everyone a moment to shut down cleanly on quit
+    deadline = time.time() + 2.0
+    for p in clients + [server]:
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if p.poll() is None:
+            p.terminate()
+
+    rtts.sort()
+    print("clients: %d, commands: %d, replies: %d, timeouts: %d" %
+            (len(joined), args.count, len(rtts), timeouts))
+    print("throughput: %.1f replies/s, %.1f commands/s" %
+            (len(rtts) / elapsed, args.count / elapsed))
+    print("rtt ms: p50 %.3f  p90 %.3f  p99 %.3f  max %.3f" %
+            tuple(1000 * percentile(rtts, p) for p in [50, 90, 99, 100]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark sensor_server with simulated Edison clients")
+    parser.add_argument("-n", "--clients", type=int, default=4,
+            help="number of simulated clients")
+    parser.add_argument("-c", "--count", type=int, default=200,
+            help="number of commands to send")
+    parser.add_argument("--cmd", default="temp",
+            help="command broadcast to every client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=TCP_PORT)
+    parser.add_argument("--latency", default=None,
+            help="simulated I/O latencies, i.e. aio=0.0002,i2c=0.001")
+    parser.add_argument("--timeout", type=float, default=2.0,
+            help="seconds to wait for all replies to one command")
+    parser.add_argument("--python", default=sys.executable,
+            help="Python 2 interpreter for the clients, default: this one")
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#       outbound.py: Per-client outbound command queue for sensor_server
+#               Continuous controls (LED PWM, LCD color) get one slot per
+#               device+action, where a newer command replaces an unsent older
+#               one; one-shot commands (buzz play, sensor reads, ...) are
+#               kept in order, and so are all commands for one device
+#               Each device is held to a maximum command rate
+#
+
+from collections import deque
+
+from config import *
+
+
+def coalesce_key(device, action):
+    """
+    coalesce_key: Slot key for commands where only the latest value matters
+
+    @param device: (str) device name, i.e. blueLED
+    @param action: (str) action, i.e. ON, may be None
+    @return key: (tuple) (device, action class), None for one-shot commands
+
+    Example usage: coalesce_key("blueLED", "ON") -> ("blueLED", "set")
+    """
+    # ON <pwm> and OFF both just set the LED, the newest one wins
+    if device[-3:].lower() == "led":
+        return (device, "set")
+
+    if device == "lcd" and action is not None and \
+            action.lower() in ["color", "colo", "setcolor"]:
+        return (device, "color")
+
+    return None
+
+
+class OutboundQueue(object):
+    """
+    OutboundQueue: Commands waiting to be sent to one client
+    Commands for one device are sent in the order they were queued, and
+    one-shot commands never overtake each other. A continuous control only
+    replaces the unsent command in its slot if nothing else for the device
+    was queued after it, so i.e. "lcd color" never jumps over an "lcd w"
+
+    Example usage: outq.put("blueLED ON 45", "blueLED", "ON", None)
+    """
+
+    def __init__(self, rate_limits=DEVICE_MAX_RATE_HZ,
+            default_rate=DEFAULT_DEVICE_RATE_HZ):
+        """
+        @param rate_limits: (dict) device name: max commands per second
+        @param default_rate: (float) max commands per second for other
+                    devices, None for no limit
+        """
+        self.rate_limits = rate_limits
+        self.default_rate = default_rate
+
+        # [device, coalesce key (None for one-shot), cmd, on_reply], in order
+        self.queue = deque()
+        self.last_sent = {}     # device: time of last send
+
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, cmd, device, action, on_reply=None):
+        """
+        put: Queues cmd, replacing an unsent command in the same slot
+
+        @param cmd: (str) command line to send
+        @param device: (str) device name cmd is for
+        @param action: (str) cmd's action, used to pick the slot
+        @param on_reply: (function) defaults None, reply callback for cmd
+        @return (bool) True if an older command was replaced
+        """
+        key = coalesce_key(device, action)
+        if key is not None:
+            # only the device's newest queued command may be replaced
+            for entry in reversed(self.queue):
+                if entry[0] != device:
+                    continue
+                if entry[1] == key:
+                    entry[2] = cmd
+                    entry[3] = on_reply
+                    self.coalesced += 1
+                    return True
+                break
+
+        self.queue.append([device, key, cmd, on_reply])
+        return False
+
+    def _ready_at(self, device):
+        rate = self.rate_limits.get(device, self.default_rate)
+        last = self.last_sent.get(device)
+        if last is None or rate is None:
+            return 0
+        return last + 1.0 / rate
+
+    def _candidates(self):
+        """
+        _candidates: Queued entries that may go next once their device is
+        under its rate limit: the oldest one per device, and of one-shot
+        commands only the oldest of all
+        """
+        seen = set()
+        one_shot_seen = False
+        for entry in self.queue:
+            device, key = entry[0], entry[1]
+            blocked = device in seen or (key is None and one_shot_seen)
+            seen.add(device)
+            if key is None:
+                one_shot_seen = True
+            if not blocked:
+                yield entry
+
+    def pop_ready(self, now):
+        """
+        pop_ready: Takes the oldest command that may go next and whose
+        device is under its rate limit
+
+        @param now: (float) current time.time()
+        @return item: (tuple) (cmd, on_reply), None if nothing may go yet
+        """
+        for entry in self._candidates():
+            if self._ready_at(entry[0]) <= now:
+                self.queue.remove(entry)
+                self.last_sent[entry[0]] = now
+                return entry[2], entry[3]
+
+        return None
+
+    def next_due(self):
+        """
+        next_due: Earliest time a queued command clears its rate limit
+
+        @return (float) time.time() value, None if the queue is empty
+        """
+        due = [self._ready_at(entry[0]) for entry in self._candidates()]
+        if not due:
+            return None
+        return min(due)
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+#       sensor_log.py: Append-only binary log of sensor readings for
+#               sensor_server, one directory per device
+#               Each reading is a fixed 16 byte record (time, board id,
+#               device id, value); each board's records go into segment
+#               files that rotate by size and age, and every LOG_INDEX_EVERY
+#               records, plus the last record of every write, a (time,
+#               record number) entry goes into the segment's index
+#               Records are stored with the time they were given, which the
+#               server keeps on its own clock, in time order within a
+#               segment; segments may overlap in time
+#               Queries memory-map the segments and return NumPy arrays
+#
+#       Example usage: python sensor_log.py /var/log/sensors temp --bucket 60
+#
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import struct
+import time
+
+from operator import itemgetter
+
+import numpy
+
+from config import *
+
+# one reading, RECORD and RECORD_DTYPE describe the same bytes
+RECORD = struct.Struct("<dHHf")
+RECORD_DTYPE = numpy.dtype([("time", "<f8"), ("board", "<u2"),
+        ("device", "<u2"), ("value", "<f4")])
+
+# one time index entry: time of record number `record` in the segment
+INDEX = struct.Struct("<dQ")
+INDEX_DTYPE = numpy.dtype([("time", "<f8"), ("record", "<u8")])
+
+DOWNSAMPLE_DTYPE = numpy.dtype([("time", "<f8"), ("mean", "<f8"),
+        ("min", "<f4"), ("max", "<f4"), ("count", "<u8")])
+
+SEGMENT_EXT = ".seg"
+INDEX_EXT = ".idx"
+NAMES_FILE = "names.json"
+
+
+def parse_reading(line):
+    """
+    parse_reading: Picks the sensor reading out of a client reply
+
+    @param line: (str) reply line, i.e. "temp: 72.500"
+    @return reading: (tuple) (device, value), None if line is not a reading
+
+    Example usage: parse_reading("temp: 72.500") -> ("temp", 72.5)
+    """
+    name, sep, value = line.partition(": ")
+    if not sep or " " in name:
+        return None
+
+    try:
+        return name, float(value)
+
+    except ValueError:
+        return None
+
+
+class _SegmentWriter(object):
+    """
+    _SegmentWriter: Buffered appends of one board's readings of one device
+    Readings are held for the log's reorder window after they arrive and
+    written in time order, so pushed batches and replies that interleave may
+    come in out of order. A reading older than one already written starts a
+    new segment instead of being reordered
+    """
+
+    def __init__(self, log, device_dir, board_id, device_id):
+        self.log = log
+        self.dir = device_dir
+        self.board_id = board_id
+        self.device_id = device_id
+        self.file = None
+        self.index = None
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.indexed = None     # last record number with an index entry
+        self.held = []          # (arrival, stamp, value) not written yet
+
+    def append(self, stamp, value):
+        self.held.append((time.time(), stamp, value))
+
+    def pending(self):
+        """
+        pending: Readings held back so far, as RECORD_DTYPE records in time
+        order
+        """
+        rows = numpy.zeros(len(self.held), RECORD_DTYPE)
+        if self.held:
+            rows["time"] = [h[1] for h in self.held]
+            rows["value"] = [h[2] for h in self.held]
+            rows["board"] = self.board_id
+            rows["device"] = self.device_id
+            rows = rows[numpy.argsort(rows["time"], kind="mergesort")]
+        return rows
+
+    def flush(self, everything=False):
+        """
+        flush: Writes the readings that have been held for the reorder
+        window, or all of them
+
+        @param everything: (bool) defaults False, write every held reading
+        """
+        if everything:
+            ready, self.held = self.held, []
+        else:
+            cutoff = time.time() - self.log.reorder_window
+            ready = [h for h in self.held if h[0] <= cutoff]
+            self.held = [h for h in self.held if h[0] > cutoff]
+
+        if not ready:
+            return
+
+        recs = []
+        index = []
+        for arrival, stamp, value in sorted(ready, key=itemgetter(1)):
+            if self.file is None or stamp < self.last or \
+                    self.count >= self.log.segment_records or \
+                    stamp - self.first >= self.log.segment_seconds:
+                self._write(recs, index)
+                recs, index = [], []
+                self._rotate(stamp)
+
+            if self.count % self.log.index_every == 0:
+                index.append(INDEX.pack(stamp, self.count))
+                self.indexed = self.count
+
+            recs.append(RECORD.pack(stamp, self.board_id, self.device_id,
+                    value))
+            self.count += 1
+            self.last = stamp
+
+        self._write(recs, index)
+
+    def _write(self, recs, index):
+        # the index always ends with the last record, so its last entry
+        # gives the segment's end time
+        if recs and self.indexed != self.count - 1:
+            index.append(INDEX.pack(self.last, self.count - 1))
+            self.indexed = self.count - 1
+
+        if recs:
+            self.file.write(b"".join(recs))
+            self.file.flush()
+
+        if index:
+            self.index.write(b"".join(index))
+            self.index.flush()
+
+    def _rotate(self, stamp):
+        self._close_files()
+
+        # segments are named by the time of their first record, in ms
+        ms = int(stamp * 1000)
+        while os.path.exists(os.path.join(self.dir, "%015d%s" %
+                (ms, SEGMENT_EXT))):
+            ms += 1
+
+        base = os.path.join(self.dir, "%015d" % (ms))
+        self.file = open(base + SEGMENT_EXT, "ab")
+        self.index = open(base + INDEX_EXT, "ab")
+        self.count = 0
+        self.indexed = None
+        self.first = stamp
+
+    def _close_files(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.index.close()
+        self.file = None
+
+    def close(self):
+        self.flush(everything=True)
+        self._close_files()
+
+
+class SensorLog(object):
+    """
+    SensorLog: Writes and queries the reading log under one directory
+    Board and device names are stored as small ids, the id tables live in
+    names.json. Appends are buffered; flush() writes out the ones held for
+    the reorder window, queries include the rest
+
+    Example usage: log.append("board1", "temp", 72.5)
+    """
+
+    def __init__(self, path, segment_records=LOG_SEGMENT_RECORDS,
+            segment_seconds=LOG_SEGMENT_SECONDS,
+            index_every=LOG_INDEX_EVERY,
+            reorder_window=LOG_REORDER_WINDOW):
+        """
+        @param path: (str) log directory, created if missing
+        @param segment_records: (int) records per segment before rotating
+        @param segment_seconds: (float) time span of a segment before rotating
+        @param index_every: (int) records between time index entries
+        @param reorder_window: (float) seconds a reading is held before
+                    being written, so later readings with older times can
+                    still be written in order
+        """
+        self.path = path
+        self.segment_records = segment_records
+        self.segment_seconds = segment_seconds
+        self.index_every = index_every
+        self.reorder_window = reorder_window
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.names = {"boards": [], "devices": []}
+        names_path = os.path.join(path, NAMES_FILE)
+        if os.path.exists(names_path):
+            with open(names_path) as f:
+                self.names = json.load(f)
+
+        self.writers = {}
+        self.appended = 0
+
+    def _id(self, table, name):
+        names = self.names[table]
+        if name not in names:
+            names.append(name)
+            names_path = os.path.join(self.path, NAMES_FILE)
+            with open(names_path + ".tmp", "w") as f:
+                json.dump(self.names, f)
+            os.rename(names_path + ".tmp", names_path)
+
+        return names.index(name)
+
+    def append(self, board, device, value, stamp=None):
+        """
+        append: Buffers one reading
+
+        @param board: (str) board name, i.e. board1
+        @param device: (str) device name, i.e. temp
+        @param value: (float) reading
+        @param stamp: (float) defaults None, time.time() of the reading,
+                    stored as given
+        """
+        writer = self.writers.get((board, device))
+        if writer is None:
+            device_dir = os.path.join(self.path, device)
+            if not os.path.isdir(device_dir):
+                os.makedirs(device_dir)
+            writer = self.writers[(board, device)] = _SegmentWriter(self,
+                    device_dir, self._id("boards", board),
+                    self._id("devices", device))
+
+        writer.append(time.time() if stamp is None else stamp, value)
+        self.appended += 1
+
+    def flush(self, everything=False):
+        """
+        flush: Writes the buffered readings held for the reorder window to
+        their segments
+
+        @param everything: (bool) defaults False, write every buffered reading
+        """
+        for writer in self.writers.values():
+            writer.flush(everything)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def devices(self):
+        """
+        devices: Names of the devices with a log
+        """
+        return sorted(d for d in os.listdir(self.path)
+                if os.path.isdir(os.path.join(self.path, d)))
+
+    def segments(self, device):
+        """
+        segments: Segment files of a device, oldest first
+
+        @return segments: (list) (start time, path) tuples
+        """
+        device_dir = os.path.join(self.path, device)
+        if not os.path.isdir(device_dir):
+            return []
+
+        return [(int(f[:-len(SEGMENT_EXT)]) / 1000.0,
+                os.path.join(device_dir, f))
+                for f in sorted(os.listdir(device_dir))
+                if f.endswith(SEGMENT_EXT)]
+
+    def _segment_end(self, seg):
+        # time of the segment's last record from its index, None if the
+        # index doesn't end with that record (i.e. after a crash)
+        idx_path = seg[:-len(SEGMENT_EXT)] + INDEX_EXT
+        try:
+            n = os.path.getsize(seg) // RECORD_DTYPE.itemsize
+            with open(idx_path, "rb") as f:
+                f.seek(-INDEX.size, os.SEEK_END)
+                stamp, record = INDEX.unpack(f.read(INDEX.size))
+
+        except (IOError, OSError):
+            return None
+
+        return stamp if record == n - 1 else None
+
+    def _read_segment(self, seg, start, end):
+        # a crash can leave a partial record at the end, ignore it
+        n = os.path.getsize(seg) // RECORD_DTYPE.itemsize
+        if n == 0:
+            return numpy.zeros(0, RECORD_DTYPE)
+
+        recs = numpy.memmap(seg, RECORD_DTYPE, "r", shape=(n,))
+
+        # records are in time order within a segment, but segments overlap
+        if (start is not None and recs["time"][n - 1] < start) or \
+                (end is not None and recs["time"][0] >= end):
+            return numpy.zeros(0, RECORD_DTYPE)
+
+        lo, hi = 0, n
+
+        # narrow down with the index before searching the records
+        idx_path = seg[:-len(SEGMENT_EXT)] + INDEX_EXT
+        if os.path.exists(idx_path):
+            idx = numpy.fromfile(idx_path, INDEX_DTYPE)
+            idx = idx[idx["record"] < n]
+            if start is not None:
+                k = numpy.searchsorted(idx["time"], start, "left") - 1
+                if k >= 0:
+                    lo = int(idx["record"][k])
+            if end is not None:
+                k = numpy.searchsorted(idx["time"], end, "right")
+                if k < len(idx):
+                    hi = int(idx["record"][k])
+
+        times = recs["time"][lo:hi]
+        a = lo + (numpy.searchsorted(times, start, "left")
+                if start is not None else 0)
+        b = lo + (numpy.searchsorted(times, end, "left")
+                if end is not None else len(times))
+        return numpy.array(recs[a:b])
+
+    def query(self, device, start=None, end=None, board=None):
+        """
+        query: Readings of a device in a time range
+
+        @param device: (str) device name, i.e. temp
+        @param start: (float) defaults None, first time included
+        @param end: (float) defaults None, first time excluded
+        @param board: (str) defaults None, only readings from this board
+        @return readings: (numpy array) RECORD_DTYPE records, oldest first,
+                    including readings not written out yet
+
+        Example usage: log.query("temp", time.time() - 3600)
+        """
+        self.flush()
+
+        parts = []
+        for seg_start, seg in self.segments(device):
+            # named by their first record, the rest can't be earlier
+            if end is not None and seg_start >= end:
+                break
+
+            # the index ends with the segment's last record, so a segment
+            # that ends before start isn't opened at all
+            if start is not None:
+                seg_end = self._segment_end(seg)
+                if seg_end is not None and seg_end < start:
+                    continue
+
+            parts.append(self._read_segment(seg, start, end))
+
+        for (b, d), writer in self.writers.items():
+            if d == device:
+                held = writer.pending()
+                if start is not None:
+                    held = held[held["time"] >= start]
+                if end is not None:
+                    held = held[held["time"] < end]
+                parts.append(held)
+
+        rows = numpy.concatenate(parts) if parts else \
+                numpy.zeros(0, RECORD_DTYPE)
+        if len(parts) > 1:
+            rows = rows[numpy.argsort(rows["time"], kind="mergesort")]
+
+        if board is not None:
+            if board not in self.names["boards"]:
+                return rows[:0]
+            rows = rows[rows["board"] == self.names["boards"].index(board)]
+
+        return rows
+
+    def downsample(self, device, bucket, start=None, end=None, board=None):
+        """
+        downsample: Mean, min, max, and count of a device's readings per
+        time bucket, empty buckets are left out
+
+        @param device: (str) device name, i.e. temp
+        @param bucket: (float) bucket width in seconds
+        @param start: (float) defaults None, start of the first bucket,
+                    defaults to the first reading
+        @param end: (float) defaults None, first time excluded
+        @param board: (str) defaults None, only readings from this board
+        @return buckets: (numpy array) DOWNSAMPLE_DTYPE records
+
+        Example usage: log.downsample("temp", 60, time.time() - 86400)
+        """
+        rows = self.query(device, start, end, board)
+        if len(rows) == 0:
+            return numpy.zeros(0, DOWNSAMPLE_DTYPE)
+
+        t0 = rows["time"][0] if start is None else start
+        b = ((rows["time"] - t0) // bucket).astype(numpy.int64)
+        nb = int(b[-1]) + 1
+        values = rows["value"]
+
+        count = numpy.bincount(b, minlength=nb)
+        total = numpy.bincount(b, weights=values, minlength=nb)
+        lo = numpy.full(nb, numpy.inf, numpy.float32)
+        hi = numpy.full(nb, -numpy.inf, numpy.float32)
+        numpy.minimum.at(lo, b, values)
+        numpy.maximum.at(hi, b, values)
+
+        keep = count > 0
+        out = numpy.zeros(int(keep.sum()), DOWNSAMPLE_DTYPE)
+        out["time"] = t0 + numpy.nonzero(keep)[0] * bucket
+        out["mean"] = total[keep] / count[keep]
+        out["min"] = lo[keep]
+        out["max"] = hi[keep]
+        out["count"] = count[keep]
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query a sensor reading log")
+    parser.add_argument("path", help="log directory (SENSOR_LOG_DIR)")
+    parser.add_argument("device", nargs="?", help="device to query, omit to list devices")
+    parser.add_argument("--since", type=float, default=None,
+            help="seconds back from now to start at")
+    parser.add_argument("--board", default=None, help="only this board")
+    parser.add_argument("--bucket", type=float, default=None,
+            help="downsample into buckets of this many seconds")
+    args = parser.parse_args()
+
+    log = SensorLog(args.path)
+    if args.device is None:
+        for device in log.devices():
+            print(device)
+
+    else:
+        start = None if args.since is None else time.time() - args.since
+        if args.bucket:
+            for r in log.downsample(args.device, args.bucket, start,
+                    board=args.board):
+                print("%.3f mean %.3f min %.3f max %.3f n %d" % (r["time"],
+                        r["mean"], r["min"], r["max"], r["count"]))
+
+        else:
+            for r in log.query(args.device, start, board=args.board):
+                print("%.3f %s %.3f" % (r["time"],
+                        log.names["boards"][r["board"]], r["value"]))
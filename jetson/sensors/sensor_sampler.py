@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#       sensor_sampler.py: Background sensor polling for the Edison client
+#               A sampler thread reads every read-only sensor at a fixed rate
+#               and keeps the latest (value, timestamp) per sensor in a cache
+#               Command replies are served from the cache instead of doing
+#               a synchronous ADC read per request
+#
+
+import threading
+import time
+
+from config import *
+from edison_sensors import get_grove_value
+
+
+class SensorSampler(object):
+    """
+    SensorSampler: Polls sensors on a background thread into a latest-value
+    cache. The sampler thread writes the cache, and so does get() when it
+    refreshes a stale entry; both write under the HW lock, so a slow read
+    never overwrites a newer one. Each cache entry is a (value, timestamp)
+    tuple that is replaced whole, so readers never take a lock and never see
+    a half-written entry.
+
+    Example usage: sampler = SensorSampler(devices, ["temp", "light"]).start()
+    """
+
+    def __init__(self, device_dict, sensor_names, rate_hz=SAMPLE_RATE_HZ,
+            read_fn=get_grove_value):
+        """
+        @param device_dict: (dict) sensor name(key): sensor obj (value)
+        @param sensor_names: (list) names of the read-only sensors to poll
+        @param rate_hz: (float) polls per second for each sensor
+        @param read_fn: (function) HW read call, takes a sensor obj
+        """
+        self.devices = device_dict
+        self.sensor_names = list(sensor_names)
+        self.period = 1.0 / rate_hz
+        self.read_fn = read_fn
+
+        self.cache = {}
+
+        # serializes HW access and cache writes between the sampler thread
+        # and on-demand refreshes, cache readers never touch it
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        start: Takes one synchronous sample of every sensor so the cache is
+        never empty, then starts the polling thread
+
+        @return self: (SensorSampler) for chaining
+        """
+        if self._thread is not None:
+            return self
+
+        for name in self.sensor_names:
+            self.sample(name)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stop: Signals the polling thread to exit and waits for it
+        """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def sample(self, name):
+        """
+        sample: Reads sensor name from HW and stores it in the cache
+
+        @param name: (str) sensor name, key in device_dict
+        @return entry: (tuple) (value, timestamp) that was stored
+        """
+        with self._io_lock:
+            value = self.read_fn(self.devices[name])
+            entry = (value, time.time())
+            self.cache[name] = entry
+        return entry
+
+    def get(self, name, max_age=SAMPLE_MAX_AGE):
+        """
+        get: Returns the cached reading for name if it is fresh enough,
+        otherwise reads the sensor now
+
+        @param name: (str) sensor name, key in device_dict
+        @param max_age: (float) oldest acceptable reading, in seconds
+        @return value: (float) sensor reading
+        @return age: (float) seconds since the reading was taken
+
+        Example usage: sampler.get("temp", 0.2)
+        """
+        entry = self.cache.get(name)
+
+        if entry is None or time.time() - entry[1] > max_age:
+            entry = self.sample(name)
+
+        value, stamp = entry
+        return value, time.time() - stamp
+
+    def _run(self):
+        next_due = time.time()
+
+        while not self._stop.is_set():
+            for name in self.sensor_names:
+                try:
+                    self.sample(name)
+
+                except Exception as e:
+                    print "[SAMPLER] %s read failed: %s" % (name, e)
+
+            # fixed-rate schedule, skip ahead instead of bursting if a
+            # round of reads ran over the period
+            next_due += self.period
+            now = time.time()
+            if next_due < now:
+                next_due = now
+
+            self._stop.wait(next_due - now)
@@ -2,18 +2,105 @@
 #	sensor_server.py: Server-side program to run Jetson TX2 dev board
 #				Creates a binded host socket with IP in config.py
 #				Handles multiple clients with socket mux select	
-#				Currently receives commands from stdin and sends to all clients
+#				Receives commands from stdin and sends each one only to the
+#				clients that own the commanded device (see device_registry.py)
+#				Commands wait in a per-client OutboundQueue (outbound.py) and
+#				are sent as the client answers, at most MAX_IN_FLIGHT at a time
+#				Each sent command carries an id the client echoes back on its
+#				reply, i.e. "#12 temp" -> "#12 temp: 72.500"
+#				Per-client stats (server_metrics.py) are served as JSON on
+#				127.0.0.1:STATS_PORT and optionally dumped to STATS_DUMP_PATH
+#				Sensor readings (replies and pushes) are appended to the
+#				log in SENSOR_LOG_DIR when it is set, see sensor_log.py
+#				Other code in the same process can queue commands through a
+#				CommandQueue instead of stdin, i.e. the gesture bridge
 #				
 
+from __future__ import print_function
+
+import itertools
+import os
 import socket
 import sys
 import select
+import time
+
+from collections import deque
 
 from config import *
+from device_registry import DeviceRegistry
+from outbound import OutboundQueue
+from sensor_log import SensorLog, parse_reading
+from server_metrics import ServerMetrics
+from subscriptions import is_push, decode_push
+
+try:
+	input = raw_input
+except NameError:
+	pass
 
 MAX_CLIENTS = 5
 
 client_dict = {}
+recv_bufs = {}
+registry = DeviceRegistry()
+metrics = ServerMetrics()
+
+# commands whose device is the second token, i.e. "sub temp 2 db 0.5"
+DEVICE_ARG_COMMANDS = ["sub", "unsub"]
+
+# per client, FIFO of (send time, command id, command, reply callback) for
+# commands still waiting on a reply (callback None if nobody is waiting on
+# it), clients reply in order; entries older than REPLY_TIMEOUT are failed,
+# see expire_replies
+pending_replies = {}
+
+# ids put on sent commands, see tag_command
+command_ids = itertools.count(1)
+
+# per client, commands not sent yet
+outbound = {}
+
+# SensorLog of every reading, None when SENSOR_LOG_DIR is not set
+readings_log = None
+
+
+class CommandQueue(object):
+	"""
+	CommandQueue: In-process command source for main(), used like stdin
+	put() may be called from any thread; a pipe wakes the server's select
+	loop, so the server never polls the queue
+
+	Example usage: cmd_queue.put("blueLED ON 45", on_reply=callback)
+	"""
+
+	def __init__(self):
+		self.commands = deque()
+		self._rd, self._wr = os.pipe()
+
+	def fileno(self):
+		return self._rd
+
+	def put(self, cmd, on_reply=None):
+		"""
+		put: Queues cmd to be sent to the clients that own its device
+
+		@param cmd: (str) command, same syntax as typed into stdin
+		@param on_reply: (function) defaults None, called from the server
+					thread with each client's reply line
+		"""
+		self.commands.append((cmd, on_reply))
+		os.write(self._wr, b"c")
+
+	def drain(self):
+		"""
+		drain: Returns every queued (cmd, on_reply) tuple, oldest first
+		"""
+		os.read(self._rd, 4096)
+		cmds = []
+		while self.commands:
+			cmds.append(self.commands.popleft())
+		return cmds
 
 
 def start_server(host, port, num_clients):
@@ -29,8 +116,8 @@ def start_server(host, port, num_clients):
 
 	Example usage: start_server("192.168.1.2", 8000, 10)
 	"""
-	print "[SERVER] Starting server w/ IP: %s, port: %s" % (host, port)
-	print "[SERVER] Max # clients supported: %d" % (num_clients)
+	print("[SERVER] Starting server w/ IP: %s, port: %s" % (host, port))
+	print("[SERVER] Max # clients supported: %d" % (num_clients))
 	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 	sock.setblocking(False)
@@ -40,6 +127,61 @@ def start_server(host, port, num_clients):
 	return sock
 
 
+def start_stats_server(port):
+	"""
+	start_stats_server: Creates the local stats socket; every connection
+	gets the current stats JSON and is closed
+
+	@param port: (int) TCP port on 127.0.0.1, None to disable
+	@return sock: (socket obj) listening socket, None if disabled/unavailable
+
+	Example usage: start_stats_server(8889)
+	"""
+	if port is None:
+		return None
+
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	try:
+		sock.bind(("127.0.0.1", port))
+
+	except socket.error as e:
+		print("[SERVER] Stats socket unavailable on port %d: %s" % (port, e))
+		sock.close()
+		return None
+
+	sock.setblocking(False)
+	sock.listen(MAX_CLIENTS)
+	print("[SERVER] Stats on 127.0.0.1:%d" % (port))
+
+	return sock
+
+
+def queue_depths():
+	"""
+	queue_depths: Queued and in-flight command counts per board, for metrics
+	"""
+	return dict((registry.names[c], (len(outbound[c]),
+		len(pending_replies.get(c, ())))) for c in outbound)
+
+
+def serve_stats(stats_sock):
+	"""
+	serve_stats: Answers one connection on the stats socket
+
+	@param stats_sock: (socket obj) socket from start_stats_server
+	"""
+	conn, addr = stats_sock.accept()
+	try:
+		conn.setblocking(True)
+		conn.sendall((metrics.to_json(queue_depths()) + "\n").encode())
+
+	except socket.error:
+		pass
+
+	conn.close()
+
+
 def close_server(host_sock, client_list):
 	"""
 	close_server: Handles graceful shutdown of server and client sockets
@@ -50,15 +192,15 @@ def close_server(host_sock, client_list):
 						when first connected
 
 	"""
-	print "[SERVER] Server %s shutting down..." % (SERVER_IP) ,
+	print("[SERVER] Server %s shutting down..." % (SERVER_IP), end=" ")
 	clients = [c for c in client_list if (c != host_sock) and (c != sys.stdin)]
 	for client in clients:
-		client.send("quit")
+		client.send(b"quit\n")
 		client.close()
 
 	host_sock.close()
 
-	print "done\n"
+	print("done\n")
 
 
 def connect_client(sock):
@@ -72,53 +214,384 @@ def connect_client(sock):
 	@param sock: (socket obj) host/server TCP socket object
 	@return conn: (socket obj) new client TCP socket object
 	@return addr: (tuple) 2-tuple with IP and address of new client
+	@return available_sensors: (list) device names announced by the client
 
 	Example usage: connect_client(start_server("192.168.1.2", 8000, 10))
 
 	"""
 	conn, addr = sock.accept()
-	print "[SERVER] Client %s has connected, addr: %s" % (conn, addr)
-	available_sensors = conn.recv(BUFFER_SIZE).split(" ")
-	print "[CLIENT %s] Available sensors: " % (addr[0]) ,
+	print("[SERVER] Client %s has connected, addr: %s" % (conn, addr))
+	available_sensors = conn.recv(BUFFER_SIZE).decode().split()
+	print("[CLIENT %s] Available sensors: " % (addr[0]), end=" ")
 	for sensor in available_sensors:
-		print sensor + ",",
-	print
+		print(sensor + ",", end=" ")
+	print()
 	
 	conn.setblocking(False)
 
-	return conn, addr
+	return conn, addr, available_sensors
+
+
+def disconnect_client(sock):
+	"""
+	disconnect_client: Forgets a client that closed its connection
+
+	@param sock: (socket obj) client TCP socket object
+	"""
+	print("[SERVER] Client %s has disconnected" % (registry.label(sock)))
+	metrics.on_disconnect(registry.names[sock])
+	registry.remove(sock)
+	client_dict.pop(sock, None)
+	recv_bufs.pop(sock, None)
+	pending_replies.pop(sock, None)
+	outbound.pop(sock, None)
+	sock.close()
+
+
+def recv_lines(sock):
+	"""
+	recv_lines: Reads from a client socket and splits the stream into the
+	newline-delimited replies/pushes it carries. A partial line at the end
+	is kept in recv_bufs until the rest of it arrives
 
+	@param sock: (socket obj) client TCP socket object
+	@return lines: (list) complete lines received, None if client closed
+
+	Example usage: recv_lines(client_sock)
+	"""
+	data = sock.recv(BUFFER_SIZE)
+	if not data:
+		return None
+
+	metrics.on_recv(registry.names[sock], len(data))
+	lines = (recv_bufs.get(sock, "") + data.decode()).split("\n")
+	recv_bufs[sock] = lines.pop()
+
+	return [l for l in lines if l]
+
+
+def print_reply(sock, line):
+	"""
+	print_reply: Prints a client reply, decoding subscription pushes into
+	one line per sample
+
+	@param sock: (socket obj) client TCP socket object
+	@param line: (str) one line received from the client
+	"""
+	if not is_push(line):
+		print("[CLIENT %s] %s" % (registry.label(sock), line))
+		return
+
+	name, samples = decode_push(line)
+	for stamp, value in samples:
+		print("[CLIENT %s] %s @ %.3f: %.3f" % (registry.label(sock), name,
+			stamp, value))
+
+
+def send_command(cmd, on_reply=None):
+	"""
+	send_command: Queues one command for the clients that own its device,
+	along with on_reply so the matching reply line can be handed back to it
+	The device may be prefixed with a board name to reach a single board,
+	i.e. "board2.redLED ON 50"; exit/quit goes to every client right away
+	A queued LED/LCD color command replaces an unsent one for the same
+	device, see outbound.py
+
+	@param cmd: (str) command from stdin or a CommandQueue
+	@param on_reply: (function) defaults None, called with each reply line
+	@return (bool) False if cmd shuts the server down
+
+	Example usage: send_command("blueLED ON 45")
+	"""
+	if cmd in ["exit", "q", "quit"]:
+		print("sending data to %d client(s)" % (len(client_dict.keys())))
+		for client in client_dict.keys():
+			metrics.on_send(registry.names[client],
+				client.send((cmd + "\n").encode()), command=False)
+		return False
 
+	tok = cmd.split(" ")
+	idx = 1 if tok[0] in DEVICE_ARG_COMMANDS and len(tok) > 1 else 0
+	clients, tok[idx] = registry.route(tok[idx])
+	cmd = " ".join(tok)
+	device = tok[idx]
+	action = tok[idx + 1] if len(tok) > idx + 1 else None
 
-def main():
-	host_sock = start_server(SERVER_IP, TCP_PORT, MAX_CLIENTS)
+	if not clients:
+		print("[SERVER] no client owns device %s" % (device))
+		return True
+
+	print("sending data to %d client(s)" % (len(clients)))
+	for client in clients:
+		outbound[client].put(cmd, device, action, on_reply)
+
+	return True
+
+
+def tag_command(cmd, cmd_id):
+	"""
+	tag_command: Puts a command id in front of a command for the client to
+	echo back on its reply
+
+	Example usage: tag_command("temp", 12) -> "#12 temp"
+	"""
+	return "%s%d %s" % (COMMAND_TAG, cmd_id, cmd)
+
+
+def split_tag(line):
+	"""
+	split_tag: Separates the echoed command id from a client reply
+
+	@param line: (str) one line received from the client
+	@return cmd_id: (int) id of the command replied to, None if untagged
+	@return line: (str) the reply without its id
+
+	Example usage: split_tag("#12 temp: 72.500") -> (12, "temp: 72.500")
+	"""
+	if line.startswith(COMMAND_TAG):
+		tag, sep, rest = line.partition(" ")
+		try:
+			return int(tag[len(COMMAND_TAG):]), rest
+
+		except ValueError:
+			pass
+
+	return None, line
+
+
+def fail_reply(client, entry, now):
+	"""
+	fail_reply: Gives up on one in-flight command, its callback gets an
+	"!err: <cmd>: no reply" line
+
+	@param client: (socket obj) client TCP socket object
+	@param entry: (tuple) the command's pending_replies entry
+	@param now: (float) current time.time()
+	"""
+	sent, cmd_id, cmd, on_reply = entry
+	print("[SERVER] no reply from %s to \"%s\" after %.1fs" %
+		(registry.label(client), cmd, now - sent))
+	metrics.on_timeout(registry.names[client])
+	if on_reply is not None:
+		on_reply("!err: %s: no reply" % (cmd))
+
+
+def expire_replies(client, waiting, now):
+	"""
+	expire_replies: Fails the commands a client has not answered within
+	REPLY_TIMEOUT, so a lost reply does not hold an in-flight slot forever
+	A reply that still arrives later carries the id of a command no longer
+	waiting, and is dropped by handle_reply
+
+	@param client: (socket obj) client TCP socket object
+	@param waiting: (deque) the client's pending_replies entry
+	@param now: (float) current time.time()
+	"""
+	while waiting and now - waiting[0][0] > REPLY_TIMEOUT:
+		fail_reply(client, waiting.popleft(), now)
+
+
+def pump_outbound():
+	"""
+	pump_outbound: Expires unanswered commands, then sends queued commands
+	to every client that has room for more in-flight commands, within each
+	device's rate limit
+
+	@return timeout: (float) seconds until a held-back command may be sent
+				or an in-flight command expires, None if only replies
+				can free up more commands
+	"""
+	now = time.time()
+	timeout = None
+
+	for client, outq in outbound.items():
+		waiting = pending_replies.setdefault(client, deque())
+		expire_replies(client, waiting, now)
+
+		while len(waiting) < MAX_IN_FLIGHT:
+			item = outq.pop_ready(now)
+			if item is None:
+				break
+
+			cmd, on_reply = item
+			cmd_id = next(command_ids)
+			sent = client.send((tag_command(cmd, cmd_id) + "\n").encode())
+			waiting.append((now, cmd_id, cmd, on_reply))
+			metrics.on_send(registry.names[client], sent)
+
+		due = outq.next_due()
+		if due is not None and len(waiting) < MAX_IN_FLIGHT:
+			wait = max(due - now, 0)
+			timeout = wait if timeout is None else min(timeout, wait)
+
+		if waiting:
+			wait = max(waiting[0][0] + REPLY_TIMEOUT - now, 0)
+			timeout = wait if timeout is None else min(timeout, wait)
+
+	return timeout
+
+
+def handle_reply(sock, line):
+	"""
+	handle_reply: Dispatches one line received from a client; pushes are
+	printed, replies are printed and passed to the callback of the command
+	whose id they echo. Clients answer in order, so commands sent before
+	that one are failed; a reply to a command that already expired is
+	dropped
+
+	@param sock: (socket obj) client TCP socket object
+	@param line: (str) one line received from the client
+	"""
+	cmd_id, line = split_tag(line)
+	print_reply(sock, line)
+	board = registry.names[sock]
+	if is_push(line):
+		metrics.on_push(board)
+		if readings_log is not None:
+			# samples carry the board's clock, which may be off from ours;
+			# keep their spacing but end the batch at its arrival, so the
+			# log only ever sees server time
+			name, samples = decode_push(line)
+			shift = time.time() - samples[-1][0]
+			for stamp, value in samples:
+				readings_log.append(board, name, value, stamp + shift)
+		return
+
+	if readings_log is not None:
+		reading = parse_reading(line)
+		if reading is not None:
+			readings_log.append(board, reading[0], reading[1])
+
+	waiting = pending_replies.get(sock)
+	if cmd_id is None or not waiting or cmd_id < waiting[0][1]:
+		if cmd_id is not None:
+			print("[SERVER] late reply from %s dropped" %
+				(registry.label(sock)))
+			metrics.on_late_reply(board)
+		metrics.on_reply(board, None)
+		return
+
+	now = time.time()
+	while waiting and waiting[0][1] < cmd_id:
+		fail_reply(sock, waiting.popleft(), now)
+	if not waiting or waiting[0][1] != cmd_id:
+		metrics.on_reply(board, None)
+		return
+
+	sent, cmd_id, cmd, on_reply = waiting.popleft()
+	metrics.on_reply(board, now - sent)
+	if on_reply is not None:
+		on_reply(line)
+
+
+
+def main(host=SERVER_IP, port=TCP_PORT, cmd_queue=None):
+	"""
+	main: Server loop, accepts clients and forwards commands from stdin
+	(and cmd_queue, if given) until a quit command
+
+	@param host: (str) IPv4 address of local host that will run server
+	@param port: (int) TCP port number
+	@param cmd_queue: (CommandQueue) defaults None, in-process command source
+
+	Example usage: main("127.0.0.1", 8888, CommandQueue())
+	"""
+	global readings_log
+	if SENSOR_LOG_DIR:
+		readings_log = SensorLog(SENSOR_LOG_DIR)
+	next_flush = time.time()
+
+	host_sock = start_server(host, port, MAX_CLIENTS)
 	read_socks = [host_sock, sys.stdin]
+	if cmd_queue is not None:
+		read_socks.append(cmd_queue)
+
+	stats_sock = start_stats_server(STATS_PORT)
+	if stats_sock is not None:
+		read_socks.append(stats_sock)
+	next_dump = time.time()
 
 	server_on = True
 	while server_on:	
-		read_rdy, write_rdy, err_rdy = select.select(read_socks, [], [])
+		timeout = pump_outbound()
+
+		if STATS_DUMP_PATH:
+			now = time.time()
+			if now >= next_dump:
+				metrics.dump(STATS_DUMP_PATH, queue_depths())
+				next_dump = now + STATS_DUMP_INTERVAL
+			wait = next_dump - now
+			timeout = wait if timeout is None else min(timeout, wait)
+
+		if readings_log is not None:
+			now = time.time()
+			if now >= next_flush:
+				readings_log.flush()
+				next_flush = now + LOG_FLUSH_INTERVAL
+			wait = next_flush - now
+			timeout = wait if timeout is None else min(timeout, wait)
+
+		read_rdy, write_rdy, err_rdy = select.select(read_socks, [], [],
+			timeout)
 		
 		for s in read_rdy:
 			if s is host_sock:
-				new_conn, new_addr = connect_client(host_sock)
+				new_conn, new_addr, new_devices = connect_client(host_sock)
 				client_dict[new_conn] = new_addr
+				outbound[new_conn] = OutboundQueue()
 				read_socks.append(new_conn)
+				board = registry.add(new_conn, new_addr, new_devices)
+				metrics.on_connect(board, new_addr)
+				print("[SERVER] Client %s registered as %s" % (new_addr[0],
+					board))
+
+			elif s is stats_sock:
+				serve_stats(stats_sock)
 
 			elif s is sys.stdin:
-				cmd = raw_input()
-				print "sending data to %d client(s)" % (len(client_dict.keys()))
-				for client in client_dict.keys():
-					client.send(cmd)
-				if cmd in ["exit", "q", "quit"]:
-					server_on = False
+				try:
+					cmd = input()
+
+				except EOFError:
+					# stdin closed (i.e. run in the background), keep
+					# serving any cmd_queue
+					read_socks.remove(sys.stdin)
+					continue
+
+				server_on = send_command(cmd)
+				if not server_on:
 					break
+
+			elif s is cmd_queue:
+				for cmd, on_reply in cmd_queue.drain():
+					server_on = send_command(cmd, on_reply)
+					if not server_on:
+						break
+				if not server_on:
+					break
+
 			else:
-				data = s.recv(BUFFER_SIZE)
-				if data:
-					print "[CLIENT %s] %s" % (s.getsockname()[0], data)
+				lines = recv_lines(s)
+				if lines is None:
+					read_socks.remove(s)
+					disconnect_client(s)
+					continue
+
+				for line in lines:
+					handle_reply(s, line)
 	
-	close_server(host_sock, read_socks)
+	close_server(host_sock, list(client_dict.keys()))
+	if stats_sock is not None:
+		stats_sock.close()
+	if STATS_DUMP_PATH:
+		metrics.dump(STATS_DUMP_PATH, queue_depths())
+	if readings_log is not None:
+		readings_log.close()
 
 
 if __name__ == '__main__':
-	main()
+	# optional host/port override, i.e. sensor_server.py 127.0.0.1 8888
+	if len(sys.argv) > 2:
+		main(sys.argv[1], int(sys.argv[2]))
+	else:
+		main()
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#       server_metrics.py: Per-client counters and latency histograms for
+#               sensor_server: commands sent, replies, pushes, bytes in/out,
+#               command round-trip time, queue depth, and reconnects
+#               Stats are kept per board name, so they survive reconnects
+#               sensor_server serves them as JSON on a local stats socket
+#               and can dump them to a file periodically
+#
+#       Example usage: nc 127.0.0.1 8889
+#
+
+import json
+import os
+import time
+
+from config import *
+
+# upper bucket edges in ms, the last bucket is open-ended
+RTT_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+
+class LatencyHistogram(object):
+    """
+    LatencyHistogram: Fixed log-spaced buckets, cheap enough to update on
+    every reply
+    """
+
+    def __init__(self, edges=RTT_BUCKETS_MS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, sec):
+        """
+        add: Records one sample
+
+        @param sec: (float) latency in seconds
+        """
+        ms = sec * 1000.0
+        i = 0
+        while i < len(self.edges) and ms > self.edges[i]:
+            i += 1
+
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, pct):
+        """
+        percentile: Upper edge of the bucket holding the pct-th sample
+
+        @param pct: (float) 0 - 100
+        @return (float) latency in ms, None if empty
+        """
+        if self.count == 0:
+            return None
+
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.edges[i] if i < len(self.edges) else self.max
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else None,
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99),
+            "max_ms": self.max,
+            # [upper edge in ms, count], last edge None = open-ended
+            "buckets_ms": [list(b) for b in
+                    zip(list(self.edges) + [None], self.counts)],
+        }
+
+
+class ClientStats(object):
+    """
+    ClientStats: Counters for one board
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.addr = None
+        self.connected = False
+        self.connects = 0
+        self.connected_since = None
+
+        self.commands_sent = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.late_replies = 0
+        self.pushes = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.rtt = LatencyHistogram()
+
+    def to_dict(self):
+        return {
+            "board": self.board,
+            "addr": self.addr,
+            "connected": self.connected,
+            "connected_since": self.connected_since,
+            "reconnects": max(self.connects - 1, 0),
+            "commands_sent": self.commands_sent,
+            "replies": self.replies,
+            "timeouts": self.timeouts,
+            "late_replies": self.late_replies,
+            "pushes": self.pushes,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "rtt": self.rtt.to_dict(),
+        }
+
+
+class ServerMetrics(object):
+    """
+    ServerMetrics: All boards' stats, updated from the server loop only, so
+    nothing here needs a lock
+
+    Example usage: metrics.on_reply("board1", 0.002)
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.clients = {}
+
+    def client(self, board):
+        if board not in self.clients:
+            self.clients[board] = ClientStats(board)
+        return self.clients[board]
+
+    def on_connect(self, board, addr):
+        stats = self.client(board)
+        stats.addr = "%s:%d" % (addr[0], addr[1])
+        stats.connected = True
+        stats.connects += 1
+        stats.connected_since = time.time()
+
+    def on_disconnect(self, board):
+        self.client(board).connected = False
+
+    def on_send(self, board, nbytes, command=True):
+        stats = self.client(board)
+        stats.bytes_out += nbytes
+        if command:
+            stats.commands_sent += 1
+
+    def on_recv(self, board, nbytes):
+        self.client(board).bytes_in += nbytes
+
+    def on_reply(self, board, rtt):
+        stats = self.client(board)
+        stats.replies += 1
+        if rtt is not None:
+            stats.rtt.add(rtt)
+
+    def on_timeout(self, board):
+        self.client(board).timeouts += 1
+
+    def on_late_reply(self, board):
+        self.client(board).late_replies += 1
+
+    def on_push(self, board):
+        self.client(board).pushes += 1
+
+    def snapshot(self, queue_depths=None):
+        """
+        snapshot: All stats as a JSON-ready dict
+
+        @param queue_depths: (dict) board name: (queued, in flight) counts
+        @return stats: (dict)
+        """
+        queue_depths = queue_depths or {}
+        clients = {}
+        for board, stats in self.clients.items():
+            clients[board] = stats.to_dict()
+            queued, in_flight = queue_depths.get(board, (0, 0))
+            clients[board]["queued"] = queued
+            clients[board]["in_flight"] = in_flight
+
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "clients": clients,
+        }
+
+    def to_json(self, queue_depths=None):
+        return json.dumps(self.snapshot(queue_depths), indent=2,
+                sort_keys=True)
+
+    def dump(self, path, queue_depths=None):
+        """
+        dump: Writes the stats JSON to path, replacing the file atomically
+
+        @param path: (str) output file
+        @param queue_depths: (dict) see snapshot
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.to_json(queue_depths))
+        os.rename(tmp, path)
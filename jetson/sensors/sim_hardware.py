@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#       sim_hardware.py: Simulated mraa/upm backend for the Edison sensor stack
+#               Mirrors the parts of the mraa and upm APIs that
+#               edison_sensors.py uses (Pwm, Aio, Grove sensors, JHD1313M1 LCD,
+#               buzzer) so the client can run on an ordinary Linux machine
+#               Select it with EDISON_HW_BACKEND=sim
+#
+#               Each call sleeps for a configurable I/O latency, set per bus
+#               with SIM_LATENCY, i.e. SIM_LATENCY="aio=0.0002,i2c=0.001"
+#
+
+import math
+import os
+import random
+import time
+
+# seconds per call, by bus
+LATENCY = {
+    "pwm": 0.00005,     # sysfs PWM write
+    "aio": 0.0002,      # one ADC conversion
+    "i2c": 0.0005,      # one LCD command/data transfer
+    "gpio": 0.00005,    # buzzer pin toggle
+}
+
+
+def set_latency(**latencies):
+    """
+    set_latency: Overrides simulated I/O latencies
+
+    @param latencies: (float) seconds per call, keyed by bus name
+
+    Example usage: set_latency(aio=0.001, i2c=0.002)
+    """
+    for bus, sec in latencies.items():
+        if bus not in LATENCY:
+            raise ValueError("unknown bus: " + bus)
+        LATENCY[bus] = float(sec)
+
+
+def _io(bus):
+    if LATENCY[bus] > 0:
+        time.sleep(LATENCY[bus])
+
+
+def _wave(period, lo, hi):
+    # slowly varying reading with a little noise, so deadband and
+    # threshold subscriptions have something to react to
+    phase = math.sin(2 * math.pi * time.time() / period)
+    return lo + (hi - lo) * (0.5 + 0.5 * phase) + random.uniform(-0.5, 0.5)
+
+
+if os.environ.get("SIM_LATENCY"):
+    set_latency(**dict(kv.split("=")
+            for kv in os.environ["SIM_LATENCY"].split(",")))
+
+
+class Pwm(object):
+    def __init__(self, pin):
+        self.pin = pin
+        self.period = 0
+        self.enabled = False
+        self.duty = 0.0
+
+    def period_us(self, us):
+        _io("pwm")
+        self.period = us
+
+    def enable(self, state):
+        _io("pwm")
+        self.enabled = bool(state)
+
+    def write(self, duty):
+        _io("pwm")
+        self.duty = float(duty)
+
+    def read(self):
+        _io("pwm")
+        return self.duty
+
+
+class Aio(object):
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read(self):
+        _io("aio")
+        # 10-bit ADC
+        return int(min(max(_wave(7.0, 100, 900) + random.gauss(0, 40), 0),
+            1023))
+
+    def readFloat(self):
+        return self.read() / 1023.0
+
+
+class GroveRotary(object):
+    def __init__(self, pin):
+        self.pin = pin
+
+    def abs_value(self):
+        _io("aio")
+        return int(_wave(20.0, 0, 1023))
+
+    def abs_deg(self):
+        _io("aio")
+        return _wave(20.0, 0, 300)
+
+
+class GroveTemp(object):
+    def __init__(self, pin):
+        self.pin = pin
+
+    def value(self):
+        _io("aio")
+        return int(_wave(120.0, 20, 26))
+
+    def raw_value(self):
+        _io("aio")
+        return int(_wave(120.0, 480, 520))
+
+
+class GroveLight(object):
+    def __init__(self, pin):
+        self.pin = pin
+
+    def value(self):
+        _io("aio")
+        return int(_wave(45.0, 10, 600))
+
+    def raw_value(self):
+        _io("aio")
+        return int(_wave(45.0, 0, 1023))
+
+
+class Jhd1313m1(object):
+    def __init__(self, bus, lcd_addr, rgb_addr):
+        self.rows = [[" "] * 16, [" "] * 16]
+        self.cursor = [0, 0]
+        self.color = (0, 0, 0)
+        self.backlight = False
+        self.on = True
+
+    def clear(self):
+        _io("i2c")
+        self.rows = [[" "] * 16, [" "] * 16]
+        self.cursor = [0, 0]
+
+    def home(self):
+        _io("i2c")
+        self.cursor = [0, 0]
+
+    def setCursor(self, row, col):
+        _io("i2c")
+        self.cursor = [row, col]
+
+    def write(self, msg):
+        row, col = self.cursor
+        for c in msg:
+            _io("i2c")
+            if col < 16:
+                self.rows[row][col] = c
+            col += 1
+        self.cursor = [row, col]
+
+    def setColor(self, r, g, b):
+        _io("i2c")
+        self.color = (r, g, b)
+
+    def backlightOn(self):
+        _io("i2c")
+        self.backlight = True
+
+    def backlightOff(self):
+        _io("i2c")
+        self.backlight = False
+
+    def displayOn(self):
+        _io("i2c")
+        self.on = True
+
+    def displayOff(self):
+        _io("i2c")
+        self.on = False
+
+
+class Buzzer(object):
+    def __init__(self, pin):
+        self.pin = pin
+        self.volume = 1.0
+
+    def setVolume(self, vol):
+        self.volume = float(vol)
+
+    def getVolume(self):
+        return self.volume
+
+    def playSound(self, freq, duration_us):
+        # upm blocks for the length of the tone
+        _io("gpio")
+        time.sleep(duration_us / 1000000.0)
+        return freq
+
+    def stopSound(self):
+        _io("gpio")
+
+
+class _Namespace(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+# stand-ins for the modules edison_sensors.py imports
+mraa = _Namespace(Pwm=Pwm, Aio=Aio)
+grove = _Namespace(GroveRotary=GroveRotary, GroveTemp=GroveTemp,
+        GroveLight=GroveLight)
+groveLCD = _Namespace(Jhd1313m1=Jhd1313m1)
+groveBuzzer = _Namespace(Buzzer=Buzzer,
+        BUZZER_DO=3800, BUZZER_RE=3400, BUZZER_MI=3000, BUZZER_FA=2700,
+        BUZZER_SOL=2500, BUZZER_LA=2300, BUZZER_SI=2000)
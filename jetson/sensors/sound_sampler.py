@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#       sound_sampler.py: High-rate sound level engine for the Edison client
+#               A sampler thread reads the sound sensor's ADC in tight bursts
+#               into a preallocated NumPy window and, once per window,
+#               computes RMS, peak, and dB levels with array ops
+#               Samples within a burst are back to back, bursts are paced so
+#               the average rate is SOUND_RATE_HZ
+#
+#       Example usage: sound = SoundSampler(devices["sound"]).start()
+#
+
+import threading
+import time
+
+import numpy
+
+from config import *
+
+
+def sound_levels(samples, window_len, full_scale=SOUND_FULL_SCALE):
+    """
+    sound_levels: RMS, peak, and dB level of each window of samples, for all
+    windows at once. Levels are taken around each window's mean, which
+    removes the sensor's DC bias
+
+    @param samples: (numpy array) raw ADC samples, a multiple of window_len
+    @param window_len: (int) samples per window
+    @param full_scale: (float) ADC counts of a full-scale swing, 0 dB
+    @return rms: (numpy array) RMS per window, in ADC counts
+    @return peak: (numpy array) largest deviation per window, in ADC counts
+    @return db: (numpy array) RMS per window in dB relative to full_scale,
+                SOUND_DB_FLOOR at the lowest
+
+    Example usage: rms, peak, db = sound_levels(buf, 200)
+    """
+    win = numpy.asarray(samples, dtype=numpy.float32).reshape(-1, window_len)
+    ac = win - win.mean(axis=1)[:, numpy.newaxis]
+    rms = numpy.sqrt((ac * ac).mean(axis=1))
+    peak = numpy.abs(ac).max(axis=1)
+    floor = 10 ** (SOUND_DB_FLOOR / 20.0)
+    db = 20 * numpy.log10(numpy.maximum(rms / full_scale, floor))
+    return rms, peak, db
+
+
+class SoundSampler(object):
+    """
+    SoundSampler: Burst-samples one ADC pin on a background thread and keeps
+    the levels of the last SOUND_HISTORY windows. The sampler thread is the
+    only writer; the latest levels are a tuple replaced whole, so readers
+    never take a lock
+
+    Example usage: sound = SoundSampler(devices["sound"]).start()
+    """
+
+    def __init__(self, aio, rate_hz=SOUND_RATE_HZ, burst=SOUND_BURST,
+            window=SOUND_WINDOW, history=SOUND_HISTORY):
+        """
+        @param aio: (mraa.Aio) sound sensor ADC pin
+        @param rate_hz: (float) average samples per second
+        @param burst: (int) samples read back to back per burst
+        @param window: (float) seconds per level window, rounded to whole
+                    bursts
+        @param history: (int) windows of levels kept
+        """
+        self.aio = aio
+        self.rate_hz = float(rate_hz)
+        self.burst = burst
+        self.window_len = max(int(round(window * rate_hz / burst)), 1) * burst
+        self.burst_period = burst / self.rate_hz
+
+        # one window of raw samples, refilled in place
+        self.samples = numpy.zeros(self.window_len, dtype=numpy.int16)
+
+        # ring of (time, rms, peak, db) per window
+        self.history = numpy.zeros(history, dtype=[("time", numpy.float64),
+                ("rms", numpy.float32), ("peak", numpy.float32),
+                ("db", numpy.float32)])
+        self.windows = 0
+        self.latest = None
+        self.overruns = 0
+        self.errors = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        start: Starts the sampling thread
+
+        @return self: (SoundSampler) for chaining
+        """
+        if self._thread is not None:
+            return self
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stop: Signals the sampling thread to exit and waits for it
+        """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def get(self):
+        """
+        get: Levels of the most recent full window
+
+        @return levels: (tuple) (time, rms, peak, db), None before the first
+                    window is complete
+        """
+        return self.latest
+
+    def recent(self, n=None):
+        """
+        recent: Levels of the last n windows, oldest first
+
+        @param n: (int) defaults None, windows wanted, None for all kept
+        @return levels: (numpy array) records with time, rms, peak, db
+        """
+        kept = min(self.windows, len(self.history))
+        n = kept if n is None else min(n, kept)
+        idx = numpy.arange(self.windows - n, self.windows) % len(self.history)
+        return self.history[idx]
+
+    def _run(self):
+        read = self.aio.read
+        burst = self.burst
+        pos = 0
+        deadline = time.time()
+
+        while not self._stop.is_set():
+            try:
+                # the list comprehension is the cheapest per-sample loop,
+                # the NumPy copy then happens once per burst
+                self.samples[pos:pos + burst] = [read() for _ in range(burst)]
+                pos += burst
+
+                if pos == self.window_len:
+                    pos = 0
+                    self._add_window(time.time())
+
+            except Exception as e:
+                # start the window over rather than mix in stale samples
+                print("[SOUND] read failed: %s" % (e))
+                self.errors += 1
+                pos = 0
+
+            deadline += self.burst_period
+            delay = deadline - time.time()
+            if delay > 0:
+                self._stop.wait(delay)
+
+            elif delay < -self.burst_period * (self.window_len / burst):
+                # more than a window behind, drop the backlog
+                self.overruns += 1
+                deadline = time.time()
+
+    def _add_window(self, now):
+        rms, peak, db = sound_levels(self.samples, self.window_len)
+        self.history[self.windows % len(self.history)] = \
+                (now, rms[0], peak[0], db[0])
+        self.windows += 1
+        self.latest = (now, float(rms[0]), float(peak[0]), float(db[0]))
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+#       subscriptions.py: Sensor subscription streams for the Edison client
+#               The server subscribes to a sensor with a rate and either a
+#               deadband or a threshold; the client then pushes only changed
+#               or threshold-crossing samples, batched and delta-encoded
+#               Also holds the push encoder/decoder shared with sensor_server
+#
+#       Push line format (all integers, values in thousandths):
+#               @<sensor> <t0 ms> <v0> <dt ms>,<dv> <dt ms>,<dv> ...
+#       e.g.    @temp 1530000000123 72512 250,105 500,-20
+#
+
+import threading
+import time
+
+from config import *
+
+PUSH_PREFIX = "@"
+VALUE_SCALE = 1000
+
+
+def encode_push(name, samples):
+    """
+    encode_push: Delta-encodes a batch of samples into one push line
+    The first sample is absolute, each following sample is stored as the
+    difference in time (ms) and value (thousandths) to the one before it
+
+    @param name: (str) sensor name, i.e. temp
+    @param samples: (list) (timestamp, value) tuples, timestamp in seconds
+    @return line: (str) encoded push line, without the trailing newline
+
+    Example usage: encode_push("temp", [(1530000000.1, 72.5), (1530000000.4, 72.6)])
+    """
+    ticks = [(int(round(t * 1000)), int(round(v * VALUE_SCALE)))
+            for t, v in samples]
+
+    tok = [PUSH_PREFIX + name, str(ticks[0][0]), str(ticks[0][1])]
+    for prev, cur in zip(ticks, ticks[1:]):
+        tok.append("%d,%d" % (cur[0] - prev[0], cur[1] - prev[1]))
+
+    return " ".join(tok)
+
+
+def decode_push(line):
+    """
+    decode_push: Inverse of encode_push
+
+    @param line: (str) push line received from a client
+    @return name: (str) sensor name
+    @return samples: (list) (timestamp, value) tuples, timestamp in seconds
+
+    Example usage: decode_push("@temp 1530000000123 72512 250,105")
+    """
+    tok = line.strip().split(" ")
+    name = tok[0][len(PUSH_PREFIX):]
+    t_ms = int(tok[1])
+    v = int(tok[2])
+
+    samples = [(t_ms / 1000.0, float(v) / VALUE_SCALE)]
+    for delta in tok[3:]:
+        dt, dv = delta.split(",")
+        t_ms += int(dt)
+        v += int(dv)
+        samples.append((t_ms / 1000.0, float(v) / VALUE_SCALE))
+
+    return name, samples
+
+
+def is_push(line):
+    """
+    is_push: Checks whether a line received from a client is a push line
+    rather than a command reply
+
+    @param line: (str) line received from a client
+    @return (bool) True if line is a push
+    """
+    return line.startswith(PUSH_PREFIX)
+
+
+class Subscription(object):
+    """
+    Subscription: Rate and filter state for one subscribed sensor
+    mode "db" pushes when the value moves at least level away from the last
+    pushed value, mode "th" pushes when the value crosses level
+    """
+
+    def __init__(self, name, rate_hz, mode, level):
+        self.name = name
+        self.period = 1.0 / clamp(rate_hz, 0.01, SUB_MAX_RATE_HZ)
+        self.mode = mode
+        self.level = float(level)
+
+        self.next_due = time.time()
+        self.last_value = None
+        self.pending = []
+        self.pending_since = None
+
+    def offer(self, stamp, value):
+        """
+        offer: Filters a new sample, queues it for the next batch if it
+        passes the deadband/threshold check. The first sample always passes
+
+        @param stamp: (float) sample timestamp in seconds
+        @param value: (float) sensor reading
+        @return (bool) True if the sample was queued
+        """
+        last = self.last_value
+
+        if last is not None:
+            if self.mode == "db" and abs(value - last) < self.level:
+                return False
+
+            if self.mode == "th" and \
+                    (last >= self.level) == (value >= self.level):
+                return False
+
+        self.last_value = value
+        if not self.pending:
+            self.pending_since = stamp
+        self.pending.append((stamp, value))
+        return True
+
+    def take_batch(self):
+        """
+        take_batch: Returns and clears the queued samples
+        """
+        batch = self.pending
+        self.pending = []
+        self.pending_since = None
+        return batch
+
+
+class SubscriptionManager(object):
+    """
+    SubscriptionManager: Samples subscribed sensors on a background thread
+    and hands encoded push lines to send_fn. Readings come from the
+    SensorSampler cache, refreshed whenever they are older than the
+    subscription period
+
+    Example usage: subs = SubscriptionManager(sampler, send_line).start()
+    """
+
+    def __init__(self, sampler, send_fn, batch_interval=SUB_BATCH_INTERVAL,
+            batch_size=SUB_BATCH_SIZE):
+        """
+        @param sampler: (SensorSampler) background sensor cache
+        @param send_fn: (function) called with each encoded push line
+        @param batch_interval: (float) longest time, in seconds, a sample
+                    waits in a batch before it is pushed
+        @param batch_size: (int) push as soon as a batch holds this many samples
+        """
+        self.sampler = sampler
+        self.send_fn = send_fn
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+
+        self.subs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, name, rate_hz, mode, level):
+        """
+        subscribe: Adds or replaces the subscription for sensor name
+
+        @param name: (str) sensor name, must be polled by the sampler
+        @param rate_hz: (float) samples per second
+        @param mode: (str) "db" for deadband or "th" for threshold
+        @param level: (float) deadband width or threshold value
+
+        Example usage: subs.subscribe("temp", 2, "db", 0.5)
+        """
+        if name not in self.sampler.sensor_names:
+            raise ValueError("not a sensor: " + name)
+
+        if mode not in ["db", "th"]:
+            raise ValueError("invalid subscription mode: " + mode)
+
+        sub = Subscription(name, float(rate_hz), mode, level)
+        with self._lock:
+            self.subs[name] = sub
+        self._wake.set()
+
+    def unsubscribe(self, name):
+        """
+        unsubscribe: Removes the subscription for sensor name, if any
+        Samples still waiting in its batch are dropped
+
+        @param name: (str) sensor name
+        """
+        with self._lock:
+            self.subs.pop(name, None)
+
+    def start(self):
+        """
+        start: Starts the subscription thread
+
+        @return self: (SubscriptionManager) for chaining
+        """
+        if self._thread is not None:
+            return self
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stop: Signals the subscription thread to exit and waits for it
+        """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                subs = list(self.subs.values())
+
+            now = time.time()
+            wait = self.batch_interval
+
+            for sub in subs:
+                if now >= sub.next_due:
+                    value, age = self.sampler.get(sub.name, sub.period)
+                    if value is not None:
+                        sub.offer(now - age, value)
+
+                    sub.next_due += sub.period
+                    if sub.next_due < now:
+                        sub.next_due = now + sub.period
+
+                if sub.pending and \
+                        (len(sub.pending) >= self.batch_size or
+                         now - sub.pending_since >= self.batch_interval):
+                    self.send_fn(encode_push(sub.name, sub.take_batch()))
+
+                wait = min(wait, sub.next_due - now)
+                if sub.pending:
+                    wait = min(wait,
+                            sub.pending_since + self.batch_interval - now)
+
+            self._wake.wait(max(wait, 0))
+            self._wake.clear()
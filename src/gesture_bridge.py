@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import deque
+from functools import partial
+
+import cv2
+
+from open_gesture import capture_background, write_trace, MOG2Segmenter, SkinLUTSegmenter
+from video_stream import WebcamVideoStream, PiVideoStream, FrameExecutor
+import sample
+from sample import countdown, preprocessFrame
+
+# sensor_server lives with the Jetson sensor code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'jetson', 'sensors'))
+import sensor_server
+
+def hand_area(frame):
+    '''
+    Fraction of the frame covered by the largest contour
+    @param frame - thresholded gframe
+    @return - largest contour area / frame area, 0 if there are no contours
+    '''
+    contours = frame.get_contours()
+    if len(contours) == 0:
+        return 0.0
+    h, w = frame.get().shape[:2]
+    return cv2.contourArea(contours[0]) / float(w * h)
+
+def percentile(sorted_vals, pct):
+    '''
+    Nearest-rank percentile of an already sorted list
+    '''
+    if len(sorted_vals) == 0:
+        return float('nan')
+    return sorted_vals[int(round(pct / 100.0 * (len(sorted_vals) - 1)))]
+
+class GestureBridge:
+    '''
+    Turns per-frame hand area into LED commands for sensor_server
+    The hand counts as present once the area rises above on_area and as gone
+    once it falls below off_area (hysteresis); either change must hold for
+    debounce_frames frames before the LED is switched. While the hand is
+    present, the PWM duty cycle follows the area and is only resent when it
+    moves by at least pwm_step.
+    '''
+    def __init__(self, cmd_queue, device='blueLED', on_area=0.05, off_area=0.03,
+                 max_area=0.5, debounce_frames=3, pwm_step=5):
+        '''
+        @param cmd_queue - sensor_server.CommandQueue of a server in this process
+        @param device - LED to drive
+        @param on_area - area fraction above which the hand becomes present
+        @param off_area - area fraction below which the hand is gone (< on_area)
+        @param max_area - area fraction that maps to 100% duty cycle
+        @param debounce_frames - consecutive frames a presence change must hold
+        @param pwm_step - smallest duty cycle change (%) worth a command
+        '''
+        self.cmd_queue = cmd_queue
+        self.device = device
+        self.on_area = on_area
+        self.off_area = off_area
+        self.max_area = max_area
+        self.debounce_frames = debounce_frames
+        self.pwm_step = pwm_step
+
+        self.present = False
+        self.last_pwm = None
+        self._streak = 0
+        self._lock = threading.Lock()
+        self.latencies = []
+
+    def update(self, area, capture_time):
+        '''
+        Feed the result of one frame, queues a command if the LED should change
+        @param area - hand area fraction, see hand_area()
+        @param capture_time - time.time() at which the frame was captured
+        @return - command that was queued, or None
+        '''
+        threshold = self.off_area if self.present else self.on_area
+        if (area >= threshold) != self.present:
+            self._streak += 1
+            if self._streak >= self.debounce_frames:
+                self.present = not self.present
+                self._streak = 0
+        else:
+            self._streak = 0
+
+        if not self.present:
+            if self.last_pwm == 0:
+                return None
+            self.last_pwm = 0
+            return self._send('{} OFF'.format(self.device), capture_time)
+
+        span = self.max_area - self.on_area
+        pwm = int(round(100 * min(max((area - self.on_area) / span, 0), 1)))
+        # always light the LED when the hand appears
+        pwm = max(pwm, 1)
+        if self.last_pwm and abs(pwm - self.last_pwm) < self.pwm_step:
+            return None
+        self.last_pwm = pwm
+        return self._send('{} ON {}'.format(self.device, pwm), capture_time)
+
+    def _send(self, cmd, capture_time):
+        self.cmd_queue.put(cmd, on_reply=partial(self._on_ack, capture_time))
+        return cmd
+
+    def _on_ack(self, capture_time, line):
+        # runs on the server thread
+        if line.startswith('!err'):
+            # failed or never answered, not an ack
+            return
+        with self._lock:
+            self.latencies.append(time.time() - capture_time)
+
+    def latency_stats(self):
+        '''
+        Capture-to-ack latency of every acknowledged command
+        @return - dict with count and p50/p90/p99/max in ms
+        '''
+        with self._lock:
+            lat = sorted(self.latencies)
+        stats = {'count': len(lat)}
+        for name, pct in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]:
+            stats[name] = 1000 * percentile(lat, pct)
+        return stats
+
+def processFrame(segmenter, frame):
+    preprocessFrame(frame)
+    frame.segment(segmenter)
+    frame.gray()
+    frame.blur()
+    frame.threshold()
+
+async def run_async(camera, segmenter, bridge, traces=None, max_concurrency=2, show=False):
+    '''
+    Event-loop version of the frame loop
+    Frames come from `async for` over the camera, processing runs on a
+    FrameExecutor with up to max_concurrency frames in flight, and the bridge
+    sees the results in capture order. MOG2 background models are stateful
+    and must see frames in order, use max_concurrency=1 with them.
+    @param traces - deque to append frame traces to, None to not trace
+    '''
+    pipeline = FrameExecutor(max_concurrency)
+    pending = deque()
+
+    def analyse(frame):
+        processFrame(segmenter, frame)
+        frame.release()
+        return hand_area(frame)
+
+    def decide(frame, area):
+        bridge.update(area, frame.capture_time)
+        frame.mark('decision')
+        if traces is not None:
+            traces.append(frame.trace())
+        return show and frame.show("gesture bridge") == 27 # ESC
+
+    try:
+        async for frame in camera:
+            pending.append((frame, asyncio.ensure_future(pipeline.run(analyse, frame))))
+            while pending and (len(pending) >= max_concurrency or pending[0][1].done()):
+                frame, task = pending.popleft()
+                if decide(frame, await task):
+                    return
+    finally:
+        for frame, task in pending:
+            task.cancel()
+        pipeline.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-pi", "--RaspberryPi", action="store_true", help="Use raspberry pi camera interface")
+    parser.add_argument("--host", default=sensor_server.SERVER_IP, help="sensor server address")
+    parser.add_argument("--port", type=int, default=sensor_server.TCP_PORT, help="sensor server port")
+    parser.add_argument("--device", default="blueLED", help="LED driven by the hand area")
+    parser.add_argument("--show", action="store_true", help="display the processed frames")
+    parser.add_argument("--skin", action="store_true", help="segment by skin color instead of background subtraction")
+    parser.add_argument("--config", default=sample.config_path, help="tuned pipeline config to load, if it exists")
+    parser.add_argument("--trace", default=None, help="write Chrome trace-event JSON of the last frames to this file")
+    parser.add_argument("--trace-frames", type=int, default=1000, help="frames kept for --trace")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the frame loop on asyncio")
+    parser.add_argument("--concurrency", type=int, default=2, help="frames processed at once with --async (skin only)")
+    args = parser.parse_args()
+
+    sample.load_config(args.config)
+
+    # the sensor server runs in this process and takes commands from the queue
+    cmd_queue = sensor_server.CommandQueue()
+    server = threading.Thread(target=sensor_server.main, args=(args.host, args.port, cmd_queue))
+    server.daemon = True
+    server.start()
+
+    if args.RaspberryPi:
+        camera = PiVideoStream()
+    else:
+        camera = WebcamVideoStream()
+
+    bridge = GestureBridge(cmd_queue, device=args.device)
+    traces = deque(maxlen=args.trace_frames)
+
+    if camera.isOpened():
+        if args.skin:
+            segmenter = SkinLUTSegmenter()
+        else:
+            countdown(3, "capturing background in...")
+            segmenter = MOG2Segmenter(capture_background(camera, sample.bg_threshold, preprocess_cb=preprocessFrame))
+
+        try:
+            if args.use_async:
+                concurrency = args.concurrency if args.skin else 1
+                asyncio.run(run_async(camera, segmenter, bridge, traces if args.trace else None,
+                                      concurrency, args.show))
+            else:
+                seq = None
+                while True:
+                    # wait for a new frame rather than deciding on the same one again
+                    frame = camera.read(after=seq)
+                    if frame.get() is None:
+                        continue
+                    seq = frame.seq
+                    processFrame(segmenter, frame)
+                    frame.release()
+                    bridge.update(hand_area(frame), frame.capture_time)
+                    frame.mark('decision')
+                    if args.trace:
+                        traces.append(frame.trace())
+                    if args.show and frame.show("gesture bridge") == 27: # ESC
+                        break
+        except KeyboardInterrupt:
+            pass
+
+        cv2.destroyAllWindows()
+        print("capture to ack latency (ms): {}".format(bridge.latency_stats()))
+        if args.trace:
+            write_trace(traces, args.trace)
+
+    cmd_queue.put("quit")
+    server.join(1)
+    camera.release()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+import argparse
+import os
+import queue
+import time
+
+import cv2
+import numpy
+
+from multiprocessing import Event, Process, Queue, shared_memory
+
+from open_gesture import gframe, MOG2Segmenter, SkinLUTSegmenter, capture_background
+from video_stream import WebcamVideoStream, PiVideoStream, FPS
+import sample
+from sample import preprocessFrame
+
+class ShmRing:
+    '''
+    Ring of equally sized frames in a multiprocessing.shared_memory block
+    One writer process fills slot seq % slots and then stamps the slot with
+    seq; readers copy a slot out and check the stamp is unchanged afterwards,
+    so a frame overwritten mid-copy is detected instead of returned torn.
+    '''
+    def __init__(self, shape, dtype=numpy.uint8, slots=4, name=None):
+        '''
+        @param shape - shape of one frame
+        @param dtype - frame dtype
+        @param slots - frames kept in the ring
+        @param name - attach to an existing ring by name instead of creating one
+        '''
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.slots = slots
+        frame_bytes = int(numpy.prod(self.shape)) * self.dtype.itemsize
+        header_bytes = 8 * slots
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=header_bytes + frame_bytes * slots)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.stamps = numpy.ndarray((slots,), numpy.int64, buffer=self.shm.buf)
+        self.frames = numpy.ndarray((slots,) + self.shape, self.dtype, buffer=self.shm.buf, offset=header_bytes)
+        if self.owner:
+            self.stamps[:] = -1
+
+    def spec(self):
+        '''
+        Arguments to attach to this ring from another process
+        '''
+        return dict(shape=self.shape, dtype=self.dtype.str, slots=self.slots, name=self.shm.name)
+
+    def write(self, seq, arr):
+        '''
+        Store a frame (writer process only)
+        @param seq - frame sequence number, increasing (gaps are fine)
+        @param arr - frame, same shape as the ring
+        @return - slot the frame went into
+        '''
+        slot = seq % self.slots
+        self.stamps[slot] = -1
+        self.frames[slot] = arr
+        self.stamps[slot] = seq
+        return slot
+
+    def read(self, seq):
+        '''
+        Copy a frame out of the ring
+        @param seq - sequence number of the frame
+        @return - frame array, None if it has been overwritten
+        '''
+        slot = seq % self.slots
+        if self.stamps[slot] != seq:
+            return None
+        arr = self.frames[slot].copy()
+        if self.stamps[slot] != seq:
+            return None
+        return arr
+
+    def close(self):
+        '''
+        Detach from the ring, freeing it if this process created it
+        '''
+        # drop the views first, the buffer can't be closed while they exist
+        self.stamps = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def crop_shape(resolution, x_begin=0, x_end=1, y_begin=0, y_end=1):
+    '''
+    Shape gframe.crop() leaves a frame of the given resolution in
+    @param resolution - (width, height)
+    @return - (height, width)
+    '''
+    w, h = resolution
+    return (int(y_end * h) - int(y_begin * h), int(x_end * w) - int(x_begin * w))
+
+def open_camera(source, resolution):
+    '''
+    @param source - 'pi' for the Raspberry Pi camera, else a device index or video file
+    '''
+    if source == 'pi':
+        return PiVideoStream(resolution=resolution)
+    return WebcamVideoStream(int(source) if str(source).isdigit() else source)
+
+def camera_worker(camera_id, source, resolution, frame_spec, mask_spec, results, stop, cpu=None, skin=True, config=None):
+    '''
+    Capture and pipeline loop run in each worker process
+    Raw frames go to the frame ring, thresholded masks to the mask ring, and a
+    small result dict per frame to the results queue. Each capture is
+    processed once, under the camera's own seq.
+    @param camera_id - index of the camera in the supervisor
+    @param source - camera source, see open_camera()
+    @param resolution - (width, height) frames are scaled to
+    @param frame_spec, mask_spec - ShmRing.spec() of the rings to write
+    @param results - multiprocessing.Queue shared by all workers
+    @param stop - multiprocessing.Event set when the supervisor shuts down
+    @param cpu - core to pin this process to, None to leave it unpinned
+    @param skin - segment by skin color, otherwise by background subtraction
+    @param config - tuned pipeline config to load, see sample.load_config()
+    '''
+    if config is not None:
+        sample.load_config(config)
+    # the supervisor sized the rings for this resolution
+    sample.resolution = tuple(resolution)
+
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+
+    frames = ShmRing(**frame_spec)
+    masks = ShmRing(**mask_spec)
+    camera = open_camera(source, resolution)
+    try:
+        if not camera.isOpened():
+            raise IOError('camera {} ({}) could not be opened'.format(camera_id, source))
+
+        if skin:
+            segmenter = SkinLUTSegmenter()
+        else:
+            segmenter = MOG2Segmenter(capture_background(camera, sample.bg_threshold, preprocess_cb=preprocessFrame))
+
+        seq = None
+        while not stop.is_set():
+            # every capture once: wait for a frame newer than the last one
+            with camera.read(after=seq) as frame:
+                if frame.get() is None:
+                    continue
+                seq = frame.seq
+                frame.resize(*resolution)
+                slot = frames.write(seq, frame.get())
+                preprocessFrame(frame)
+                frame.segment(segmenter)
+                frame.gray()
+                frame.blur()
+                frame.threshold()
+                masks.write(seq, frame.get())
+                area = cv2.countNonZero(frame.get()) / float(frame.get().size)
+            results.put({'camera': camera_id, 'seq': seq, 'slot': slot,
+                         'capture_time': frame.capture_time, 'done_time': time.time(),
+                         'area': area, 'stages': frame.stages})
+    finally:
+        camera.release()
+        frames.close()
+        masks.close()
+
+class CameraSupervisor:
+    '''
+    Runs one capture + pipeline worker process per camera
+    Each worker owns a frame ring and a mask ring in shared memory and sends
+    per-frame results to a single queue; the supervisor aggregates them,
+    restarts workers that die and pins each worker to its own core, so the
+    cameras don't share one GIL.
+    '''
+    def __init__(self, sources, resolution=None, slots=4, skin=True, cpus=None, restart_delay=1.0, config=sample.config_path):
+        '''
+        @param sources - camera sources, see open_camera()
+        @param resolution - (width, height) frames are scaled to, defaults to
+                            the config's resolution or 320x240
+        @param slots - frames kept per ring
+        @param skin - segment by skin color, otherwise by background subtraction
+        @param cpus - cores to pin workers to (round robin), defaults to the
+                      cores this process may run on, [] to not pin
+        @param restart_delay - seconds to wait before restarting a dead worker
+        @param config - tuned pipeline config for the workers, see sample.load_config()
+        '''
+        self.config = config
+        sample.load_config(config)
+        self.sources = list(sources)
+        self.resolution = tuple(resolution or sample.resolution or (320, 240))
+        self.slots = slots
+        self.skin = skin
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        self.cpus = list(cpus)
+        self.restart_delay = restart_delay
+
+        self.results = Queue()
+        self.stop_event = Event()
+        self.frame_rings = []
+        self.mask_rings = []
+        self.workers = []
+        self.restarts = [0] * len(self.sources)
+        self.died_at = [None] * len(self.sources)
+        self.latest = [None] * len(self.sources)
+        self.fps = [FPS() for s in self.sources]
+
+    def start(self):
+        '''
+        Create the shared memory rings and start every worker
+        '''
+        w, h = self.resolution
+        mask = crop_shape(self.resolution, sample.begin_x_range, sample.end_x_range,
+                          sample.begin_y_range, sample.end_y_range)
+        for i in range(len(self.sources)):
+            self.frame_rings.append(ShmRing((h, w, 3), slots=self.slots))
+            self.mask_rings.append(ShmRing(mask, slots=self.slots))
+            self.workers.append(self._spawn(i))
+            self.fps[i].start()
+        return self
+
+    def _spawn(self, i):
+        cpu = self.cpus[i % len(self.cpus)] if self.cpus else None
+        p = Process(target=camera_worker, name='camera{}'.format(i),
+                    args=(i, self.sources[i], self.resolution, self.frame_rings[i].spec(),
+                          self.mask_rings[i].spec(), self.results, self.stop_event, cpu, self.skin, self.config))
+        p.daemon = True
+        p.start()
+        return p
+
+    def check_workers(self):
+        '''
+        Restart workers that have exited, restart_delay after they died
+        '''
+        now = time.time()
+        for i, p in enumerate(self.workers):
+            if p.is_alive() or self.stop_event.is_set():
+                continue
+            if self.died_at[i] is None:
+                print('camera {} worker exited ({}), restarting'.format(i, p.exitcode))
+                self.died_at[i] = now
+            elif now - self.died_at[i] >= self.restart_delay:
+                # the new worker counts from seq 0 again
+                self.frame_rings[i].stamps[:] = -1
+                self.mask_rings[i].stamps[:] = -1
+                self.workers[i] = self._spawn(i)
+                self.restarts[i] += 1
+                self.died_at[i] = None
+
+    def poll(self, timeout=0.1):
+        '''
+        Aggregate the results waiting in the queue
+        @param timeout - seconds to wait for the first result
+        @return - list of result dicts, in arrival order
+        '''
+        out = []
+        try:
+            item = self.results.get(timeout=timeout)
+            while True:
+                out.append(item)
+                self.latest[item['camera']] = item
+                self.fps[item['camera']].update()
+                item = self.results.get_nowait()
+        except queue.Empty:
+            pass
+        self.check_workers()
+        return out
+
+    def run(self, on_result=None, duration=None):
+        '''
+        Aggregate results until duration seconds have passed (or forever)
+        @param on_result - called with the supervisor and each result dict
+        '''
+        end = None if duration is None else time.time() + duration
+        while end is None or time.time() < end:
+            for result in self.poll():
+                if on_result is not None:
+                    on_result(self, result)
+
+    def frame(self, result):
+        '''
+        Copy of the raw frame a result was computed from, None if overwritten
+        '''
+        return self.frame_rings[result['camera']].read(result['seq'])
+
+    def mask(self, result):
+        '''
+        Copy of the thresholded mask for a result, None if overwritten
+        '''
+        return self.mask_rings[result['camera']].read(result['seq'])
+
+    def stats(self):
+        '''
+        @return - per camera dict of frames, fps, restarts and latest area
+        '''
+        stats = []
+        for i in range(len(self.sources)):
+            self.fps[i].stop()
+            latest = self.latest[i]
+            stats.append({'camera': i, 'source': self.sources[i], 'frames': self.fps[i]._numFrames,
+                          'fps': self.fps[i].fps() if self.fps[i]._numFrames else 0.0,
+                          'restarts': self.restarts[i],
+                          'area': latest['area'] if latest else None})
+        return stats
+
+    def stop(self):
+        '''
+        Stop every worker and free the shared memory
+        '''
+        self.stop_event.set()
+        for p in self.workers:
+            p.join(2)
+            if p.is_alive():
+                p.terminate()
+        for ring in self.frame_rings + self.mask_rings:
+            ring.close()
+        self.frame_rings, self.mask_rings, self.workers = [], [], []
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="camera index, video file, or 'pi' for the Raspberry Pi camera")
+    parser.add_argument("--width", type=int, default=None, help="processing width")
+    parser.add_argument("--height", type=int, default=None, help="processing height")
+    parser.add_argument("--config", default=sample.config_path, help="tuned pipeline config to load, if it exists")
+    parser.add_argument("--mog2", action="store_true", help="segment by background subtraction instead of skin color")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run, default until Ctrl-C")
+    parser.add_argument("--show", action="store_true", help="display each camera's mask")
+    args = parser.parse_args()
+
+    def show(supervisor, result):
+        mask = supervisor.mask(result)
+        if mask is not None:
+            gframe(mask).show("camera {}".format(result['camera']))
+
+    resolution = (args.width, args.height) if args.width and args.height else None
+    supervisor = CameraSupervisor(args.sources, resolution, skin=not args.mog2, config=args.config).start()
+    try:
+        supervisor.run(show if args.show else None, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        if args.show:
+            cv2.destroyAllWindows()
+
+    for s in supervisor.stats():
+        print("camera {camera} ({source}): {frames} frames, {fps:.1f} fps, {restarts} restarts".format(**s))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
 import cv2
 import numpy
 import copy
+import json
 import math
+import os
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from functools import wraps
 
 def capture_background(camera, bg_threshold, preprocess_cb=None):
     '''
@@ -21,44 +28,268 @@ def capture_background(camera, bg_threshold, preprocess_cb=None):
     
     return bg_model
 
+class Segmenter(ABC):
+    '''
+    Abstract base class for foreground (hand) segmentation backends
+    '''
+    @abstractmethod
+    def mask(self, arr):
+        '''
+        Compute the foreground mask of a frame
+        @param arr - BGR frame array
+        @return - uint8 mask, 255 for foreground and 0 for background
+        '''
+        pass
+
+class MOG2Segmenter(Segmenter):
+    '''
+    Background subtraction against a model from capture_background()
+    '''
+    def __init__(self, bg_model, learning_rate=0):
+        self.bg_model = bg_model
+        self.learning_rate = learning_rate
+        self.kernel = numpy.ones((3, 3), numpy.uint8)
+
+    def mask(self, arr):
+        fgmask = self.bg_model.apply(arr, learningRate=self.learning_rate)
+        return cv2.erode(fgmask, self.kernel, iterations=1)
+
+class SkinLUTSegmenter(Segmenter):
+    '''
+    Skin-color classification through a 3D lookup table over quantized BGR
+    The table is built once by converting every BGR bin to YCrCb or HSV and
+    applying a skin rule there, so classifying a frame needs no color
+    conversion and no background capture: just a shift, an index and a lookup.
+    '''
+    # default skin rules, (low, high) per channel of the color space
+    skin_ranges = {
+        'ycrcb': ((0, 255), (133, 173), (77, 127)),
+        'hsv': ((0, 25), (40, 255), (60, 255)),
+    }
+
+    def __init__(self, bits=5, space='ycrcb', ranges=None):
+        '''
+        @param bits - bits kept per BGR channel (table has 2^(3*bits) entries)
+        @param space - color space the skin rule is defined in, 'ycrcb' or 'hsv'
+        @param ranges - (low, high) per channel of space, defaults to skin_ranges
+        '''
+        self.bits = bits
+        self.shift = 8 - bits
+        self.space = space
+        self.lut = self._build(ranges or self.skin_ranges[space])
+
+    def _bin_colors(self):
+        '''
+        Center color of every BGR bin, in table order, as a (N, 1, 3) image
+        '''
+        n = 1 << self.bits
+        centers = (numpy.arange(n, dtype=numpy.uint16) << self.shift) + ((1 << self.shift) >> 1)
+        b, g, r = numpy.meshgrid(centers, centers, centers, indexing='ij')
+        return numpy.stack([b, g, r], axis=-1).reshape(-1, 1, 3).astype(numpy.uint8)
+
+    def _build(self, ranges):
+        code = cv2.COLOR_BGR2YCrCb if self.space == 'ycrcb' else cv2.COLOR_BGR2HSV
+        conv = cv2.cvtColor(self._bin_colors(), code).reshape(-1, 3)
+        skin = numpy.ones(len(conv), bool)
+        for c, (lo, hi) in enumerate(ranges):
+            skin &= (conv[:, c] >= lo) & (conv[:, c] <= hi)
+        return numpy.where(skin, 255, 0).astype(numpy.uint8)
+
+    def _index(self, arr):
+        q = (arr >> self.shift).astype(numpy.int32)
+        return (q[..., 0] << (2 * self.bits)) | (q[..., 1] << self.bits) | q[..., 2]
+
+    def mask(self, arr):
+        return self.lut[self._index(arr)]
+
+    def calibrate(self, frame, x_begin=0, x_end=1, y_begin=0, y_end=1, min_count=3, keep=False):
+        '''
+        Rebuild the table from the colors inside a region known to be skin
+        @param frame - gframe (BGR) with a hand inside the region
+        @param x_begin, x_end, y_begin, y_end - region, as fractions like gframe.crop
+        @param min_count - pixels a bin needs before it counts as skin
+        @param keep - add to the current table instead of replacing it
+        '''
+        roi = gframe(frame.get())
+        roi.crop(x_begin, x_end, y_begin, y_end)
+        counts = numpy.bincount(self._index(roi.get()).ravel(), minlength=len(self.lut))
+        skin = numpy.where(counts >= min_count, 255, 0).astype(numpy.uint8)
+        self.lut = numpy.maximum(self.lut, skin) if keep else skin
+        return self
+
+def stage(op):
+    '''
+    Decorator for gframe operations: appends (name, thread, start, end) to
+    the frame's stages, times from time.time() like capture_time
+    '''
+    @wraps(op)
+    def timed(self, *args, **kwargs):
+        start = time.time()
+        ret = op(self, *args, **kwargs)
+        self.stages.append((op.__name__, threading.current_thread().name, start, time.time()))
+        return ret
+    return timed
+
+def trace_events(traces):
+    '''
+    Convert frame traces to Chrome trace-event format (chrome://tracing, Perfetto)
+    Every stage becomes a complete event on the thread that ran it, and every
+    frame an async span from capture to its last stage, i.e. its latency.
+    @param traces - gframe.trace() dicts (or gframes)
+    @return - list of trace events
+    '''
+    events = []
+    tids = {}
+    def tid(thread):
+        if thread not in tids:
+            tids[thread] = len(tids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tids[thread],
+                           'args': {'name': thread}})
+        return tids[thread]
+
+    for t in traces:
+        if isinstance(t, gframe):
+            t = t.trace()
+        args = {'seq': t['seq'], 'source': t['source']}
+        for name, thread, start, end in t['stages']:
+            events.append({'name': name, 'cat': 'gframe', 'ph': 'X', 'pid': 1, 'tid': tid(thread),
+                           'ts': start * 1e6, 'dur': (end - start) * 1e6, 'args': args})
+        if t['capture_time'] is not None and t['stages']:
+            span = {'name': 'frame', 'cat': 'latency', 'pid': 1, 'tid': tid('frames'),
+                    'id': '{}:{}'.format(t['source'], t['seq']), 'args': args}
+            events.append(dict(span, ph='b', ts=t['capture_time'] * 1e6))
+            events.append(dict(span, ph='e', ts=t['stages'][-1][3] * 1e6))
+    return events
+
+def write_trace(traces, path):
+    '''
+    Write frame traces to a Chrome trace-event JSON file
+    @param traces - gframe.trace() dicts (or gframes)
+    @param path - output file
+    '''
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events(traces), 'displayTimeUnit': 'ms'}, f)
+
 class gframe:
     '''
     Supports various operations on video frames
+    Frames from a VideoStream carry where and when they were captured
+    (source, seq, capture_time); every operation appends its timing to stages.
     '''
     gaussian_blur_value = 41
     binary_threshold = 60
     learning_rate = 0
 
-    def __init__(self, arr):
+    def __init__(self, arr, release_cb=None, capture_time=None, seq=None, source=None, stages=None):
+        '''
+        @param arr - frame array
+        @param release_cb - gives a borrowed buffer back, called by release()
+        @param capture_time - time.time() at which the frame was captured
+        @param seq - frame number within its source
+        @param source - id of the camera or file the frame came from
+        @param stages - stages recorded so far, see stage()
+        '''
         self.frame = arr
+        self.capture_time = capture_time
+        self.seq = seq
+        self.source = source
+        self.stages = stages if stages is not None else []
+        self._release = release_cb
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        '''
+        Give a frame borrowed from VideoStream.read() back to the stream
+        Without it the buffer goes back once no array uses it any more (ops
+        that return a new array, e.g. flip or gray, already stop using it).
+        Arrays taken from the frame before release() must not be used after.
+        '''
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def detach(self):
+        '''
+        Copy a frame borrowed from VideoStream.read() out of the stream's
+        buffer and give the buffer back, for frames kept around longer than
+        the stream's few buffers are meant to be lent
+        '''
+        if self._release is not None:
+            self.frame = self.frame.copy()
+            self.release()
     
     def get(self):
         return self.frame
 
+    def mark(self, name):
+        '''
+        Record a point in time, e.g. when a decision was made from the frame
+        '''
+        now = time.time()
+        self.stages.append((name, threading.current_thread().name, now, now))
+
+    def latency(self):
+        '''
+        Seconds from capture to the end of the last stage, None if unknown
+        '''
+        if self.capture_time is None or not self.stages:
+            return None
+        return self.stages[-1][3] - self.capture_time
+
+    def trace(self):
+        '''
+        The frame's metadata without the image, for trace_events()
+        '''
+        return {'seq': self.seq, 'source': self.source, 'capture_time': self.capture_time,
+                'stages': list(self.stages)}
+
+    @stage
     def flip(self, dir=1):
         self.frame = cv2.flip(self.frame, dir)
     
+    @stage
     def gray(self):
         self.frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
 
+    @stage
     def blur(self):
         self.frame = cv2.GaussianBlur(self.frame, (self.gaussian_blur_value, self.gaussian_blur_value), 0)
 
+    @stage
     def threshold(self):
         self.frame = cv2.threshold(self.frame, self.binary_threshold, 255, cv2.THRESH_BINARY)[1]
 
+    @stage
     def get_contours(self):
         '''Returns list of contours, sorted by area (largest to smallest)'''
         cpy = copy.deepcopy(self.frame)
-        _,contours,hierarchy = cv2.findContours(cpy, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 (contours, hierarchy)
+        contours = cv2.findContours(cpy, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
         return sorted(contours, key=lambda c: cv2.contourArea(c), reverse=True)
 
     def remove_bg(self, bg_model):
-        fgmask = bg_model.apply(self.frame,learningRate=self.learning_rate)
-        kernel = numpy.ones((3, 3), numpy.uint8)
-        fgmask = cv2.erode(fgmask, kernel, iterations=1)
+        self.segment(MOG2Segmenter(bg_model, self.learning_rate))
+
+    @stage
+    def segment(self, segmenter):
+        '''
+        Keep only the foreground pixels
+        @param segmenter - Segmenter implementation (MOG2Segmenter, SkinLUTSegmenter)
+        '''
+        fgmask = segmenter.mask(self.frame)
         self.frame = cv2.bitwise_and(self.frame, self.frame, mask=fgmask)
     
+    @stage
+    def resize(self, width, height):
+        if self.frame.shape[1::-1] != (width, height):
+            self.frame = cv2.resize(self.frame, (width, height), interpolation=cv2.INTER_AREA)
+
+    @stage
     def crop(self, x_begin=0, x_end=1, y_begin=0, y_end=1):
         self.frame = self.frame[int(y_begin * self.frame.shape[0]):int(y_end * self.frame.shape[0]), 
                          int(x_begin * self.frame.shape[1]):int(x_end * self.frame.shape[1])]
@@ -68,6 +299,280 @@ class gframe:
         cv2.imshow(title, self.frame)
         return cv2.waitKey(wait)
         
+class gframe_batch:
+    '''
+    A batch of equally sized frames held in one (N, H, W[, C]) array
+    crop/flip/gray/threshold run over the whole batch at once; blur and
+    remove_bg are OpenCV-only, so they run frame by frame in chunks of
+    chunk_size. Each frame ends up identical to the single-frame gframe path.
+    The blur, threshold and learning rate settings are gframe's, read when
+    each operation runs.
+    '''
+    chunk_size = 64
+
+    def __init__(self, arr):
+        self.frames = arr
+
+    @classmethod
+    def from_sequence(cls, seq):
+        '''
+        Stack the frames of a gframe_sequence (or list of gframes) into a batch
+        '''
+        return cls(numpy.stack([f.get() for f in seq]))
+
+    def to_sequence(self):
+        '''
+        Split the batch back into a gframe_sequence
+        '''
+        return gframe_sequence([gframe(f) for f in self.frames])
+
+    def __getitem__(self, index):
+        return gframe(self.frames[index])
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get(self):
+        return self.frames
+
+    def flip(self, dir=1):
+        # same flip codes as cv2.flip: >0 horizontal, 0 vertical, <0 both
+        if dir != 0:
+            # mirroring works row by row, so flip the batch as one tall image
+            self.frames = cv2.flip(self._tall(), 1).reshape(self.frames.shape)
+        if dir <= 0:
+            self.frames = self.frames[:, ::-1]
+
+    def gray(self):
+        # the color conversion is per pixel, so the batch can go through
+        # cvtColor as one tall image
+        self.frames = cv2.cvtColor(self._tall(), cv2.COLOR_BGR2GRAY).reshape(self.frames.shape[:3])
+
+    def blur(self):
+        k = (gframe.gaussian_blur_value, gframe.gaussian_blur_value)
+        self._map(lambda f: cv2.GaussianBlur(f, k, 0))
+
+    def threshold(self):
+        self.frames = cv2.threshold(self._tall(), gframe.binary_threshold, 255, cv2.THRESH_BINARY)[1].reshape(self.frames.shape)
+
+    def remove_bg(self, bg_model):
+        '''
+        Apply a background model frame by frame, in order
+        @param bg_model - background model from capture_background()
+        '''
+        self.segment(MOG2Segmenter(bg_model, gframe.learning_rate))
+
+    def segment(self, segmenter):
+        '''
+        Keep only the foreground pixels of each frame, in order
+        @param segmenter - Segmenter implementation (MOG2Segmenter, SkinLUTSegmenter)
+        '''
+        def keep(f):
+            return cv2.bitwise_and(f, f, mask=segmenter.mask(f))
+        self._map(keep)
+
+    def crop(self, x_begin=0, x_end=1, y_begin=0, y_end=1):
+        h, w = self.frames.shape[1:3]
+        self.frames = self.frames[:, int(y_begin * h):int(y_end * h),
+                                  int(x_begin * w):int(x_end * w)]
+
+    def _tall(self):
+        '''
+        The batch as one (N*H, W[, C]) image, stacking frames vertically
+        '''
+        n, h = self.frames.shape[:2]
+        return numpy.ascontiguousarray(self.frames).reshape((n * h,) + self.frames.shape[2:])
+
+    def _map(self, op):
+        '''
+        Run a single-frame op over the batch, chunk_size frames at a time,
+        writing into one preallocated output array
+        '''
+        out = None
+        for start in range(0, len(self.frames), self.chunk_size):
+            chunk = numpy.ascontiguousarray(self.frames[start:start + self.chunk_size])
+            for i, f in enumerate(chunk):
+                res = op(f)
+                if out is None:
+                    out = numpy.empty((len(self.frames),) + res.shape, res.dtype)
+                out[start + i] = res
+        if out is not None:
+            self.frames = out
+
+# one row of gframe_features, 40 bytes
+feature_dtype = numpy.dtype([
+    ('seq', numpy.int64),       # frame number, -1 if unknown
+    ('time', numpy.float64),    # capture time, nan if unknown
+    ('area', numpy.float32),    # largest contour area, fraction of the frame
+    ('cx', numpy.float32),      # centroid of the largest contour (px), nan without one
+    ('cy', numpy.float32),
+    ('x', numpy.int16),         # bounding box of the largest contour (px)
+    ('y', numpy.int16),
+    ('w', numpy.int16),
+    ('h', numpy.int16),
+    ('hull', numpy.int16),      # convex hull point count
+    ('defects', numpy.int16),   # convexity defects deeper than defect_depth
+])
+
+def extract_features(frame, defect_depth=20):
+    '''
+    Geometry of the largest contour of a thresholded frame
+    @param frame - thresholded gframe
+    @param defect_depth - px a convexity defect must be deep to count (i.e. between fingers)
+    @return - tuple in feature_dtype order
+    '''
+    seq = -1 if frame.seq is None else frame.seq
+    t = numpy.nan if frame.capture_time is None else frame.capture_time
+    contours = frame.get_contours()
+    if len(contours) == 0:
+        return (seq, t, 0, numpy.nan, numpy.nan, 0, 0, 0, 0, 0, 0)
+
+    c = contours[0]
+    h, w = frame.get().shape[:2]
+    m = cv2.moments(c)
+    if m['m00'] > 0:
+        cx, cy = m['m10'] / m['m00'], m['m01'] / m['m00']
+    else:
+        cx, cy = numpy.nan, numpy.nan
+    x, y, bw, bh = cv2.boundingRect(c)
+    hull = cv2.convexHull(c, returnPoints=False)
+    defects = 0
+    if len(hull) > 3:
+        try:
+            d = cv2.convexityDefects(c, hull)
+        except cv2.error:
+            # self-intersecting hull indices, no defects to report
+            d = None
+        if d is not None:
+            # depth is fixed point with 8 fractional bits
+            defects = int(numpy.count_nonzero(d.reshape(-1, 4)[:, 3] > defect_depth * 256))
+    return (seq, t, cv2.contourArea(c) / float(w * h), cx, cy, x, y, bw, bh, len(hull), defects)
+
+class gframe_features:
+    '''
+    Capture per-frame geometry (feature_dtype rows) instead of images
+    Rows go into a preallocated structured array. Without a path the array
+    doubles when full; with a path full blocks are appended to the file as
+    raw records and the array is reused, so memory stays fixed however long
+    the capture runs.
+    '''
+    def __init__(self, capacity=4096, path=None, defect_depth=20):
+        '''
+        @param capacity - rows to preallocate
+        @param path - file to append rows to, None to keep everything in memory
+        @param defect_depth - see extract_features()
+        '''
+        self.data = numpy.zeros(capacity, feature_dtype)
+        self.count = 0
+        self.path = path
+        self.defect_depth = defect_depth
+        self.file = open(path, 'ab') if path else None
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Memory-map a feature file written by a previous capture
+        @return - read-only structured array of feature_dtype rows
+        '''
+        return numpy.memmap(path, feature_dtype, 'r')
+
+    def __len__(self):
+        return len(self.get())
+
+    def __getitem__(self, index):
+        return self.get()[index]
+
+    def append_frame(self, frame):
+        '''
+        Record the features of a thresholded frame
+        '''
+        if self.count == len(self.data):
+            if self.file:
+                self.flush()
+            else:
+                self.data = numpy.concatenate([self.data, numpy.zeros(len(self.data), feature_dtype)])
+        self.data[self.count] = extract_features(frame, self.defect_depth)
+        self.count += 1
+
+    def flush(self):
+        '''
+        Append the buffered rows to the file (no-op without a path)
+        '''
+        if self.file and self.count:
+            self.file.write(self.data[:self.count].tobytes())
+            self.file.flush()
+            self.count = 0
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def get(self):
+        '''
+        Every row recorded so far
+        @return - structured array, a memmap of the file when writing to one
+        '''
+        if self.path is None:
+            return self.data[:self.count]
+        self.flush()
+        return self.load(self.path) if os.path.getsize(self.path) else self.data[:0]
+
+    def capture(self, camera, num_frames=None, preprocess_cb=None):
+        '''
+        Capture features from the camera, one row per captured frame
+        Stops early if the camera delivers no new frame within read()'s timeout.
+        @param camera - VideoStream object
+        @param num_frames - number of frames to capture, None until interrupted
+        @param preprocess_cb - callback that leaves each frame thresholded
+        '''
+        i = 0
+        seq = None
+        try:
+            while num_frames is None or i < num_frames:
+                # wait for a new frame rather than recording the same one again
+                with camera.read(after=seq) as f:
+                    if f.get() is None:
+                        break
+                    seq = f.seq
+                    if preprocess_cb != None:
+                        preprocess_cb(f)
+                    self.append_frame(f)
+                i += 1
+        except KeyboardInterrupt:
+            pass
+        self.flush()
+
+    def area_above(self, min_area):
+        '''
+        Rows whose largest contour covers more than min_area of the frame
+        '''
+        rows = self.get()
+        return rows[rows['area'] > min_area]
+
+    def velocity(self):
+        '''
+        Centroid velocity between consecutive rows
+        @return - (vx, vy) arrays in px/s, one shorter than the rows; nan
+                  where either row has no contour or no capture time, or
+                  both have the same one
+        '''
+        rows = self.get()
+        dt = numpy.diff(rows['time'])
+        dt[dt <= 0] = numpy.nan
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            vx = numpy.diff(rows['cx'].astype(numpy.float64)) / dt
+            vy = numpy.diff(rows['cy'].astype(numpy.float64)) / dt
+        return vx, vy
+
+    def speed(self):
+        '''
+        Centroid speed between consecutive rows, px/s
+        '''
+        vx, vy = self.velocity()
+        return numpy.hypot(vx, vy)
+
 class gframe_sequence:
     '''
     Capture and playback a sequence of gframe objects
@@ -98,6 +603,8 @@ class gframe_sequence:
                 preprocess_cb(f)
             if(show_frames):
                 f.show("capturing sequence")
+            # the sequence outlives the camera's buffers, keep a copy
+            f.detach()
             self.append_frame(f)
 
         if(show_frames):
@@ -112,3 +619,10 @@ class gframe_sequence:
             k = frame.show(title="playback", wait=wait)
             if(k == 27): # ESC
                 break
+
+    def write_trace(self, path):
+        '''
+        Write the sequence's frame timings as Chrome trace-event JSON
+        @param path - output file
+        '''
+        write_trace(self.sequence, path)
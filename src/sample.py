@@ -1,5 +1,5 @@
-import cv2, numpy, argparse
-from open_gesture import gframe_sequence, capture_background
+import cv2, numpy, argparse, json, os
+from open_gesture import gframe, gframe_features, gframe_sequence, capture_background, MOG2Segmenter, SkinLUTSegmenter
 from video_stream import WebcamVideoStream, PiVideoStream
 from time import sleep
 from functools import partial
@@ -17,6 +17,39 @@ end_x_range=1
 begin_y_range=0.2
 end_y_range=1
 
+# (width, height) frames are scaled to before processing, None to keep the camera's
+resolution = None
+
+# tuned pipeline settings, written by tune.py
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_config.json')
+
+def load_config(path=config_path):
+    '''
+    Apply a pipeline configuration written by tune.py, if the file exists
+    @param path - JSON config file
+    @return - the config dict, None if there is no file
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        config = json.load(f)
+    apply_config(config)
+    return config
+
+def apply_config(config):
+    '''
+    Set the pipeline constants from a config dict, keys missing from it are left as they are
+    @param config - dict with any of the keys tune.py writes
+    '''
+    global bg_threshold, begin_x_range, end_x_range, begin_y_range, end_y_range, resolution
+    gframe.gaussian_blur_value = config.get('gaussian_blur_value', gframe.gaussian_blur_value)
+    gframe.binary_threshold = config.get('binary_threshold', gframe.binary_threshold)
+    bg_threshold = config.get('bg_threshold', bg_threshold)
+    if 'crop' in config:
+        begin_x_range, end_x_range, begin_y_range, end_y_range = config['crop']
+    if 'resolution' in config:
+        resolution = tuple(config['resolution']) if config['resolution'] else None
+
 def countdown(n, msg):
     print(msg)
     sleep(1)
@@ -27,17 +60,22 @@ def countdown(n, msg):
     sleep(1)
 
 def preprocessFrame(frame):
+    if resolution is not None:
+        frame.resize(*resolution)
     frame.flip()
     frame.crop(x_begin=begin_x_range, x_end=end_x_range, 
                y_begin=begin_y_range, y_end=end_y_range)
 
-def processFrame(bg_model, frame):
+def maskFrame(segmenter, frame):
     preprocessFrame(frame)
-    frame.remove_bg(bg_model)
+    frame.segment(segmenter)
     frame.gray()
     frame.blur()
     frame.threshold()
 
+def processFrame(segmenter, frame):
+    maskFrame(segmenter, frame)
+
     contours = frame.get_contours()
     if(len(contours) > 0):
         hull = cv2.convexHull(contours[0])
@@ -49,20 +87,47 @@ def processFrame(bg_model, frame):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-pi", "--RaspberryPi", action="store_true", help="Use raspberry pi camera interface")
+    parser.add_argument("--skin", action="store_true", help="Segment by skin color instead of background subtraction")
+    parser.add_argument("--calibrate", action="store_true", help="Calibrate skin color from a hand held in the middle of the frame (with --skin)")
+    parser.add_argument("--config", default=config_path, help="Tuned pipeline config to load, if it exists")
+    parser.add_argument("--features", action="store_true", help="Record per-frame hand geometry instead of images, until Ctrl-C")
+    parser.add_argument("--features-file", default=None, help="Append the recorded features to this file (with --features)")
     args = parser.parse_args()
 
+    load_config(args.config)
+
     if args.RaspberryPi:
         camera = PiVideoStream()
     else:
         camera = WebcamVideoStream()
 
     if camera.isOpened():
-        countdown(3, "capturing background in...")
-        bg_model = capture_background(camera, bg_threshold, preprocess_cb=preprocessFrame)
+        if args.skin:
+            segmenter = SkinLUTSegmenter()
+            if args.calibrate:
+                countdown(3, "hold your hand in the middle of the frame...")
+                frame = camera.read()
+                preprocessFrame(frame)
+                segmenter.calibrate(frame, x_begin=0.3, x_end=0.7, y_begin=0.3, y_end=0.7)
+        else:
+            countdown(3, "capturing background in...")
+            bg_model = capture_background(camera, bg_threshold, preprocess_cb=preprocessFrame)
+            segmenter = MOG2Segmenter(bg_model)
+
+        if args.features:
+            print("recording features, Ctrl-C to stop")
+            features = gframe_features(path=args.features_file)
+            features.capture(camera, preprocess_cb=partial(maskFrame, segmenter))
+            rows = features.get()
+            print("{} frames, hand in view in {}, peak speed {:.0f} px/s".format(
+                len(rows), len(features.area_above(0.05)), numpy.nanmax(features.speed(), initial=0)))
+            features.close()
+            camera.release()
+            return
 
         countdown(3, "capturing sequence in...")
         sequence = gframe_sequence()
-        sequence.capture(camera, num_frames, preprocess_cb=partial(processFrame, bg_model), show_frames=show_during_capture)
+        sequence.capture(camera, num_frames, preprocess_cb=partial(processFrame, segmenter), show_frames=show_during_capture)
         
         sequence.playback(1)
         cv2.destroyAllWindows()
@@ -0,0 +1,237 @@
+import argparse
+import heapq
+import json
+import math
+
+import numpy
+
+from open_gesture import extract_features, gframe_features
+
+def centroid_path(source):
+    '''
+    Hand-centroid path of a recording
+    @param source - thresholded gframe_sequence (or list of gframes),
+                    gframe_features, feature rows, or an (N, 2) array
+    @return - (N, 2) float array of (x, y), nan where there was no hand
+    '''
+    if isinstance(source, gframe_features):
+        source = source.get()
+    if isinstance(source, numpy.ndarray):
+        if source.dtype.names:
+            return numpy.column_stack([source['cx'], source['cy']]).astype(numpy.float64)
+        return numpy.asarray(source, numpy.float64)
+    # extract_features returns cx, cy at positions 3 and 4
+    return numpy.array([extract_features(f)[3:5] for f in source], numpy.float64)
+
+def normalize_path(path, n=32):
+    '''
+    Resample a path to n points evenly spaced along its length, centered on
+    its mean and scaled so its larger side spans 1, so the same shape matches
+    whatever its speed, position and size
+    @param path - (N, 2) points, rows with nan are dropped
+    @param n - points in the result
+    @return - (n, 2) float array
+    '''
+    path = numpy.asarray(path, numpy.float64)
+    path = path[~numpy.isnan(path).any(axis=1)]
+    if len(path) < 2:
+        raise ValueError('path needs at least 2 points, got {}'.format(len(path)))
+
+    along = numpy.concatenate([[0], numpy.cumsum(numpy.hypot(*numpy.diff(path, axis=0).T))])
+    if along[-1] == 0:
+        return numpy.zeros((n, 2))
+    at = numpy.linspace(0, along[-1], n)
+    out = numpy.column_stack([numpy.interp(at, along, path[:, 0]), numpy.interp(at, along, path[:, 1])])
+    out -= out.mean(axis=0)
+    return out / max(numpy.ptp(out, axis=0).max(), 1e-9)
+
+def envelope(paths, band):
+    '''
+    Upper and lower LB_Keogh envelopes of paths
+    @param paths - (M, n, 2) normalized paths
+    @param band - warping band half-width, in points
+    @return - (upper, lower), each (M, n, 2): min/max of each path within
+              band points of every index
+    '''
+    n = paths.shape[1]
+    padded = numpy.pad(paths, ((0, 0), (band, band), (0, 0)), mode='edge')
+    shifted = numpy.stack([padded[:, k:k + n] for k in range(2 * band + 1)])
+    return shifted.max(axis=0), shifted.min(axis=0)
+
+def lb_keogh(query, upper, lower):
+    '''
+    LB_Keogh lower bound of the banded DTW distance from query to each path
+    Every query point is matched to some path point inside the band, which
+    is at least as far away as the envelope box around those points.
+    @param query - (n, 2) normalized path
+    @param upper, lower - envelopes from envelope()
+    @return - (M,) lower bounds, same scale as dtw()
+    '''
+    outside = numpy.maximum(query - upper, 0) + numpy.maximum(lower - query, 0)
+    return numpy.sqrt((outside ** 2).sum(axis=2)).sum(axis=1) / query.shape[0]
+
+def dtw(query, paths, band):
+    '''
+    Banded DTW distance from query to each of paths, all at once
+    Cells on one anti-diagonal of the warping matrix don't depend on each
+    other, so every step fills a whole anti-diagonal for all paths together.
+    @param query - (n, 2) normalized path
+    @param paths - (M, n, 2) normalized paths
+    @param band - Sakoe-Chiba band half-width, in points
+    @return - (M,) summed point distances along the best warping path, / n
+    '''
+    m, n = paths.shape[:2]
+    # cost[k, i, j] = distance from query point i to path k's point j
+    cost = numpy.sqrt(((query[None, :, None, :] - paths[:, None, :, :]) ** 2).sum(axis=3))
+    acc = numpy.full((m, n + 1, n + 1), numpy.inf)
+    acc[:, 0, 0] = 0
+    for d in range(2 * n - 1):
+        i = numpy.arange(max(0, d - n + 1), min(n - 1, d) + 1)
+        j = d - i
+        inside = numpy.abs(i - j) <= band
+        i, j = i[inside], j[inside]
+        # acc is shifted by one: cell (i, j) lives at acc[i + 1, j + 1]
+        best = numpy.minimum(numpy.minimum(acc[:, i, j], acc[:, i, j + 1]), acc[:, i + 1, j])
+        acc[:, i + 1, j + 1] = cost[:, i, j] + best
+    return acc[:, n, n] / n
+
+class TemplateLibrary:
+    '''
+    Named trajectory templates matched with banded DTW
+    Templates are stored normalized, with their LB_Keogh envelopes. match()
+    bounds every template with LB_Keogh first and runs the full DTW only on
+    candidates, in order of their bound, until no bound can beat the best
+    distances found so far.
+    '''
+    def __init__(self, n=32, band=4, batch=32):
+        '''
+        @param n - points every path is resampled to
+        @param band - warping band half-width, in points
+        @param batch - templates per vectorized DTW call
+        '''
+        self.n = n
+        self.band = band
+        self.batch = batch
+        self.names = []
+        self.paths = numpy.zeros((0, n, 2))
+        self.upper = self.lower = self.paths
+        self.dtw_count = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, path):
+        '''
+        Add a template
+        @param name - label reported by match(), several templates may share one
+        @param path - (N, 2) points, see centroid_path()
+        '''
+        self.extend([(name, path)])
+
+    def extend(self, templates):
+        '''
+        Add several (name, path) templates
+        '''
+        templates = list(templates)
+        paths = numpy.array([normalize_path(p, self.n) for name, p in templates]).reshape(-1, self.n, 2)
+        upper, lower = envelope(paths, self.band)
+        self.names += [name for name, p in templates]
+        self.paths = numpy.concatenate([self.paths, paths])
+        self.upper = numpy.concatenate([self.upper, upper])
+        self.lower = numpy.concatenate([self.lower, lower])
+
+    def match(self, path, k=1, max_distance=numpy.inf):
+        '''
+        Find the templates closest to a path
+        @param path - (N, 2) points, see centroid_path()
+        @param k - number of matches to return
+        @param max_distance - ignore templates further away than this
+        @return - list of (name, distance), closest first
+        '''
+        if len(self.names) == 0:
+            return []
+        query = normalize_path(path, self.n)
+        bounds = lb_keogh(query, self.upper, self.lower)
+        order = numpy.argsort(bounds)
+        # max-heap of the k best as (-distance, index)
+        best = []
+        self.dtw_count = 0
+        for start in range(0, len(order), self.batch):
+            limit = -best[0][0] if len(best) == k else max_distance
+            idx = order[start:start + self.batch]
+            idx = idx[bounds[idx] < limit]
+            if len(idx) == 0:
+                # bounds are sorted, no later template can do better
+                break
+            dist = dtw(query, self.paths[idx], self.band)
+            self.dtw_count += len(idx)
+            for i, d in zip(idx, dist):
+                if d >= max_distance:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-d, i))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, i))
+        return [(self.names[i], float(-d)) for d, i in sorted(best, reverse=True)]
+
+    def save(self, path):
+        '''
+        Write the templates (normalized) to a JSON file
+        '''
+        with open(path, 'w') as f:
+            json.dump({'n': self.n, 'band': self.band,
+                       'templates': [[name, p.tolist()] for name, p in zip(self.names, self.paths)]}, f)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read templates written by save(), or any {"templates": [[name, points], ...]}
+        '''
+        with open(path) as f:
+            data = json.load(f)
+        library = cls(n=data.get('n', 32), band=data.get('band', 4))
+        library.extend((name, numpy.array(p)) for name, p in data['templates'])
+        return library
+
+def shape_templates(points=64):
+    '''
+    Synthetic templates for common drawn shapes, in image coordinates (y down)
+    @return - list of (name, (points, 2) path)
+    '''
+    t = numpy.linspace(0, 1, points)
+    turn = 2 * math.pi * t
+    line = numpy.column_stack([t, numpy.zeros(points)])
+    zig = numpy.column_stack([t, numpy.abs((4 * t) % 2 - 1)])
+    return [
+        ('circle_cw', numpy.column_stack([numpy.cos(turn), numpy.sin(turn)])),
+        ('circle_ccw', numpy.column_stack([numpy.cos(turn), -numpy.sin(turn)])),
+        ('zigzag', zig),
+        ('swipe_right', line),
+        ('swipe_left', line[::-1]),
+        ('swipe_down', line[:, ::-1]),
+        ('swipe_up', line[::-1, ::-1]),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("features", help="feature file recorded with sample.py --features")
+    parser.add_argument("--templates", default=None, help="template library JSON, default: built-in shapes")
+    parser.add_argument("--last", type=int, default=None, help="only match the last N frames")
+    parser.add_argument("-k", type=int, default=3, help="matches to show")
+    args = parser.parse_args()
+
+    if args.templates:
+        library = TemplateLibrary.load(args.templates)
+    else:
+        library = TemplateLibrary()
+        library.extend(shape_templates())
+
+    path = centroid_path(gframe_features.load(args.features))
+    if args.last:
+        path = path[-args.last:]
+    for name, distance in library.match(path, k=args.k):
+        print("{:12s} {:.4f}".format(name, distance))
+    print("full DTW on {} of {} templates".format(library.dtw_count, len(library)))
+
+if __name__ == '__main__':
+    main()
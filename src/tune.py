@@ -0,0 +1,220 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+import cv2
+
+from multiprocessing import Pool, TimeoutError
+
+import sample
+from open_gesture import gframe, MOG2Segmenter
+
+# parameter values swept by default
+default_grid = {
+    'gaussian_blur_value': [21, 31, 41],
+    'binary_threshold': [40, 60, 80],
+    'bg_threshold': [30, 50, 70],
+    'crop': [[0.5, 1, 0.2, 1], [0.4, 1, 0.1, 1], [0, 1, 0, 1]],
+    'resolution': [[320, 240], [240, 180], [160, 120]],
+}
+
+def load_clip(path):
+    '''
+    Read a labelled clip: a video file plus a JSON label file next to it
+    (same name, .json extension) listing the frame ranges with a hand in view:
+        {"present": [[start, end], ...]}   (end exclusive)
+    The first frame must show the empty background.
+    @param path - video file
+    @return - (list of BGR frames, list of bool labels per frame)
+    '''
+    with open(os.path.splitext(path)[0] + '.json') as f:
+        labels = json.load(f)
+
+    stream = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        grabbed, frame = stream.read()
+        if not grabbed:
+            break
+        frames.append(frame)
+    stream.release()
+    if not frames:
+        raise IOError('no frames in {}'.format(path))
+
+    present = [False] * len(frames)
+    for start, end in labels['present']:
+        for i in range(start, min(end, len(frames))):
+            present[i] = True
+    return frames, present
+
+def largest_area(mask):
+    '''
+    Largest contour area as a fraction of the mask, like gesture_bridge.hand_area
+    '''
+    # contours are second to last in both the OpenCV 3 and 4 return values
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if len(contours) == 0:
+        return 0.0
+    return max(cv2.contourArea(c) for c in contours) / float(mask.size)
+
+def evaluate_clip(frames, present, on_area):
+    '''
+    Run the pipeline over a clip with the current constants
+    @return - (frames labelled correctly, seconds spent processing)
+    '''
+    start = time.perf_counter()
+    bg = gframe(frames[0])
+    sample.preprocessFrame(bg)
+    bg_model = cv2.createBackgroundSubtractorMOG2(0, sample.bg_threshold)
+    bg_model.apply(bg.get(), learningRate=0)
+    segmenter = MOG2Segmenter(bg_model)
+
+    correct = 0
+    for frame, label in zip(frames[1:], present[1:]):
+        f = gframe(frame)
+        sample.preprocessFrame(f)
+        f.segment(segmenter)
+        f.gray()
+        f.blur()
+        f.threshold()
+        correct += (largest_area(f.get()) >= on_area) == label
+    return correct, time.perf_counter() - start
+
+# clips decoded once per worker process, see init_worker()
+_clips = None
+
+def init_worker(paths):
+    global _clips
+    # each worker is one process, keep OpenCV from spawning threads of its own
+    cv2.setNumThreads(1)
+    _clips = [load_clip(p) for p in paths]
+
+def evaluate(args):
+    '''
+    Score one configuration over every clip (runs in a worker process)
+    @param args - (config dict, on_area)
+    @return - (config, accuracy, fps), accuracy and fps are 0 if the pipeline failed
+    '''
+    config, on_area = args
+    correct = total = 0
+    elapsed = 0.0
+    try:
+        sample.apply_config(config)
+        for frames, present in _clips:
+            c, t = evaluate_clip(frames, present, on_area)
+            correct += c
+            total += len(frames) - 1
+            elapsed += t
+    except Exception as e:
+        # one bad combination should not end the whole sweep
+        print('config {} failed: {}'.format(json.dumps(config, sort_keys=True), e))
+        return config, 0.0, 0.0
+    return config, correct / float(total), total / elapsed
+
+def check_grid(grid):
+    '''
+    Reject grid values the pipeline cannot run with, before any work is started
+    @raise ValueError - naming the first bad value
+    '''
+    for k in grid.get('gaussian_blur_value', []):
+        if k <= 0 or k % 2 == 0:
+            raise ValueError('gaussian_blur_value must be odd and positive, got {}'.format(k))
+    for t in list(grid.get('binary_threshold', [])) + list(grid.get('bg_threshold', [])):
+        if not 0 <= t <= 255:
+            raise ValueError('thresholds must be in 0-255, got {}'.format(t))
+    for crop in grid.get('crop', []):
+        if len(crop) != 4 or not (0 <= crop[0] < crop[1] <= 1 and 0 <= crop[2] < crop[3] <= 1):
+            raise ValueError('crop must be [begin_x, end_x, begin_y, end_y] within 0-1, got {}'.format(crop))
+    for res in grid.get('resolution', []):
+        if res is not None and (len(res) != 2 or min(res) <= 0):
+            raise ValueError('resolution must be [width, height] or null, got {}'.format(res))
+
+def configs(grid):
+    '''
+    Every combination of the grid's values, as config dicts
+    '''
+    keys = sorted(grid)
+    for values in itertools.product(*[grid[k] for k in keys]):
+        yield dict(zip(keys, values))
+
+def tune(paths, grid=default_grid, target=0.9, on_area=0.05, budget=None, processes=None, seed=0):
+    '''
+    Sweep the grid in parallel and pick the fastest config that is accurate enough
+    Configurations are tried in random order, so a sweep cut short by the time
+    budget still samples the whole grid.
+    @param paths - labelled clips, see load_clip()
+    @param grid - parameter name: list of values
+    @param target - minimum fraction of frames labelled correctly
+    @param on_area - area fraction above which a hand counts as present
+    @param budget - seconds after which no more results are waited for, None for no limit
+    @param processes - worker processes, defaults to the number of cores
+    @param seed - shuffle seed
+    @return - (best config or None, list of (config, accuracy, fps) evaluated)
+    @raise ValueError - if the grid has a value the pipeline cannot run with
+    '''
+    check_grid(grid)
+    todo = list(configs(grid))
+    random.Random(seed).shuffle(todo)
+
+    results = []
+    deadline = None if budget is None else time.time() + budget
+    pool = Pool(processes, initializer=init_worker, initargs=(paths,))
+    try:
+        it = pool.imap_unordered(evaluate, [(c, on_area) for c in todo])
+        for i in range(len(todo)):
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                results.append(it.next(timeout))
+            except TimeoutError:
+                print('time budget exceeded after {} of {} configs'.format(len(results), len(todo)))
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+    good = [r for r in results if r[1] >= target]
+    best = max(good, key=lambda r: r[2])[0] if good else None
+    return best, results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("clips", nargs="+", help="labelled video clips (labels in <clip>.json)")
+    parser.add_argument("--target", type=float, default=0.9, help="minimum detection accuracy")
+    parser.add_argument("--on-area", type=float, default=0.05, help="hand area fraction that counts as present")
+    parser.add_argument("--budget", type=float, default=None, help="time budget in seconds")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--grid", default=None, help="JSON file with the values to sweep, default: default_grid")
+    parser.add_argument("-o", "--output", default=sample.config_path, help="config file to write")
+    args = parser.parse_args()
+
+    grid = default_grid
+    if args.grid:
+        with open(args.grid) as f:
+            grid = dict(default_grid, **json.load(f))
+
+    try:
+        best, results = tune(args.clips, grid, args.target, args.on_area, args.budget, args.processes)
+    except ValueError as e:
+        parser.error(str(e))
+    for config, accuracy, fps in sorted(results, key=lambda r: -r[2])[:10]:
+        print("{:6.1f} fps  {:5.1%} accurate  {}".format(fps, accuracy, json.dumps(config, sort_keys=True)))
+
+    if best is None:
+        top = max(r[1] for r in results) if results else 0
+        print("no config reached {:.1%} accuracy (best {:.1%}), {} not written".format(args.target, top, args.output))
+        return 1
+
+    config, accuracy, fps = [r for r in results if r[0] is best][0]
+    out = dict(best, tuned={'accuracy': accuracy, 'fps': fps, 'target': args.target,
+                            'on_area': args.on_area, 'clips': args.clips})
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2, sort_keys=True)
+    print("wrote {} ({:.1f} fps, {:.1%} accurate)".format(args.output, fps, accuracy))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,16 @@
 # https://www.pyimagesearch.com/2015/12/28/increasing-raspberry-pi-fps-with-python-and-opencv/
 # https://www.pyimagesearch.com/2016/01/04/unifying-picamera-and-cv2-videocapture-into-a-single-class-with-opencv/
 
+import asyncio
 import cv2
 import datetime
+import numpy
+import time
+import weakref
 
-from threading import Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Condition, Event, Thread, current_thread
 from abc import ABC, abstractmethod
 from open_gesture import gframe
 
@@ -36,12 +42,167 @@ class FPS:
     def fps(self):
         return self._numFrames / self.elapsed()
 
+class _Loan:
+    '''
+    Owner of a lent frame array: the array, and every view taken from it,
+    keeps the loan alive, and the buffer goes back to the pool when the last
+    of them is garbage collected (or release() is called first)
+    '''
+    def __init__(self, pool, index, arr):
+        self.__array_interface__ = arr.__array_interface__
+        self.arr = arr
+        self.release = weakref.finalize(self, pool.release, index)
+
+class FramePool:
+    '''
+    Frame buffers handed between a capture thread and its readers
+    The capture thread fills a free buffer and publishes it; readers borrow
+    the latest published buffer, which is not written again until every
+    borrower has released it. With one reader this is a triple buffer: one
+    being written, one published, one lent out. The pool grows if readers
+    hold on to more buffers than that.
+    '''
+    def __init__(self, shape, dtype=numpy.uint8, num_buffers=3, size=None):
+        '''
+        @param shape - buffer shape the camera writes, e.g. (240, 320, 3)
+        @param dtype - buffer dtype
+        @param num_buffers - buffers to preallocate
+        @param size - (height, width) of the frame inside a padded buffer, None if unpadded
+        '''
+        self.shape = shape
+        self.dtype = dtype
+        self.size = size
+        self.buffers = [numpy.empty(shape, dtype) for i in range(num_buffers)]
+        self.refs = [0] * num_buffers
+        self.meta = [None] * num_buffers
+        self.seq = 0
+        self.latest = None
+        self.cond = Condition()
+        # called (under cond) whenever a frame is published or the stream stops
+        self.listeners = set()
+
+    def acquire(self):
+        '''
+        Get a buffer for the capture thread to write into (capture thread only)
+        @return - buffer index
+        '''
+        with self.cond:
+            for i in range(len(self.buffers)):
+                if self.refs[i] == 0 and i != self.latest:
+                    return i
+            # every buffer is published or lent out
+            self.buffers.append(numpy.empty(self.shape, self.dtype))
+            self.refs.append(0)
+            self.meta.append(None)
+            return len(self.buffers) - 1
+
+    def publish(self, index, arr=None, start=None):
+        '''
+        Make a filled buffer the latest frame (capture thread only)
+        The frame is stamped with the next sequence number and a capture stage
+        from start to now, on the calling thread.
+        @param index - buffer index from acquire()
+        @param arr - array the camera actually wrote, if it replaced the buffer
+        @param start - time.time() the capture began, defaults to now
+        '''
+        now = time.time()
+        capture = ('capture', current_thread().name, start or now, now)
+        with self.cond:
+            if arr is not None:
+                self.buffers[index] = arr
+            self.meta[index] = (self.seq, capture)
+            self.seq += 1
+            self.latest = index
+            self.cond.notify_all()
+            for fn in self.listeners:
+                fn()
+
+    def wake(self):
+        '''
+        Wake every listener without publishing, e.g. when the stream stops
+        '''
+        with self.cond:
+            for fn in self.listeners:
+                fn()
+
+    def lend(self, timeout=None, after=None):
+        '''
+        Borrow the latest frame, waiting for the first one if needed
+        The buffer is given back when the returned array and every view of it
+        are gone, or earlier by calling the returned release function.
+        @param timeout - seconds to wait for a frame, None to wait forever
+        @param after - wait for a frame with a seq greater than this, None for any
+        @return - (frame array, release function, seq, capture stage), None
+                  if no such frame was published within timeout
+        '''
+        # self.seq is the number the next published frame will get
+        ready = lambda: self.latest is not None and (after is None or self.seq - 1 > after)
+        with self.cond:
+            if not self.cond.wait_for(ready, timeout):
+                return None
+            index = self.latest
+            self.refs[index] += 1
+            seq, capture = self.meta[index]
+        loan = _Loan(self, index, self.buffers[index])
+        arr = numpy.asarray(loan)
+        if self.size is not None:
+            arr = arr[:self.size[0], :self.size[1]]
+        return arr, loan.release, seq, capture
+
+    def release(self, index):
+        '''
+        Return a borrowed buffer
+        '''
+        with self.cond:
+            self.refs[index] -= 1
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+class FrameExecutor:
+    '''
+    Runs blocking frame work (gframe ops, segmenters) off the event loop
+    At most max_concurrency calls run at once; others wait for a slot without
+    blocking the loop. OpenCV releases the GIL, so a thread pool is enough.
+    '''
+    def __init__(self, max_concurrency=2, executor=None):
+        '''
+        @param max_concurrency - calls allowed to run at the same time
+        @param executor - concurrent.futures executor to use, defaults to a
+                          thread pool of max_concurrency threads
+        '''
+        self.max_concurrency = max_concurrency
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_concurrency)
+        self._own_executor = executor is None
+        self._slots = None
+
+    async def run(self, fn, *args, **kwargs):
+        '''
+        Call fn(*args, **kwargs) in the executor
+        @return - fn's return value
+        '''
+        if self._slots is None:
+            # created on first use so it binds to the running loop
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        if self._own_executor:
+            self.executor.shutdown()
+
 class VideoStream(ABC):
     '''
     Abstract base class for various camera/video stream implementations
+    Implementations set self.pool (a FramePool) before calling this constructor
+    and publish every captured frame into it
     '''
-    def __init__(self, frame=None):
-        self.frame = frame
+    source = None
+
+    def __init__(self):
+        self._next_seq = 0
         self.kill = None
         self.stopped = True
         self.start()
@@ -54,7 +215,7 @@ class VideoStream(ABC):
             return self
         self.kill = Event()
         self.stopped = False
-        Thread(target=self.update, args=()).start()
+        Thread(target=self.update, args=(), name='capture {}'.format(self.source)).start()
         return self
  
     def stop(self):
@@ -62,12 +223,68 @@ class VideoStream(ABC):
         Stop reading new frames
         '''
         self.stopped = True
+        self.pool.wake()
 
-    def read(self):
+    def read(self, timeout=1.0, after=None):
         '''
         Get the last frame read by the camera
+        The frame is lent out without a copy. Its buffer is reused once the
+        frame's array and every view of it have been garbage collected, or
+        when release() is called on the frame (or its with block ends), after
+        which arrays taken from it must not be used any more.
+        The frame is stamped with its source, sequence number and the time
+        the capture completed.
+        @param timeout - seconds to wait for a frame, None to wait forever
+        @param after - seq of the last frame processed, to wait for a newer one
+                       instead of getting the same frame again
+        @return - gframe, holding None if the camera delivered no frame in time
+        '''
+        lent = self.pool.lend(timeout, after)
+        if lent is None:
+            return gframe(None, source=self.source)
+        arr, release, seq, capture = lent
+        return gframe(arr, release_cb=release, capture_time=capture[3],
+                      seq=seq, source=self.source, stages=[capture])
+
+    async def read_next(self):
+        '''
+        Wait for a frame newer than the last one read_next() returned
+        The capture thread wakes the event loop when it publishes a frame, so
+        waiting neither blocks the loop nor polls. If the caller falls behind,
+        intermediate frames are skipped and the latest one is returned.
+        @return - gframe as from read(), None once the stream is stopped
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            fut = loop.create_future()
+            wake = partial(loop.call_soon_threadsafe, _resolve, fut)
+            with self.pool.cond:
+                if self.pool.seq > self._next_seq:
+                    break
+                if self.stopped:
+                    return None
+                self.pool.listeners.add(wake)
+            try:
+                await fut
+            finally:
+                with self.pool.cond:
+                    self.pool.listeners.discard(wake)
+
+        frame = self.read()
+        self._next_seq = frame.seq + 1
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
         '''
-        return gframe(self.frame)
+        async for frame in stream: ... (ends when the stream is stopped)
+        '''
+        frame = await self.read_next()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
 
     def release(self):
         '''
@@ -104,17 +321,29 @@ class WebcamVideoStream(VideoStream):
     Also works for reading in video files, src=/path/to/file
     '''
     def __init__(self, src=0):
+        self.source = str(src)
         self.stream = cv2.VideoCapture(src)
         self.stream.set(10,200)
-        self.grabbed, self.frame = self.stream.read()
-        super().__init__(self.frame)
+        self.grabbed, frame = self.stream.read()
+        if self.grabbed:
+            self.pool = FramePool(frame.shape, frame.dtype)
+            self.pool.publish(0, frame)
+        else:
+            self.pool = FramePool((0, 0, 3))
+        super().__init__()
     
     def update(self):
         while True:
             if self.stopped:
                 self.kill.set() # signal thread is ending
                 return
-            self.grabbed, self.frame = self.stream.read()
+            index = self.pool.acquire()
+            buf = self.pool.buffers[index]
+            start = time.time()
+            # VideoCapture decodes straight into buf if the size matches
+            self.grabbed, frame = self.stream.read(buf if buf.size else None)
+            if self.grabbed:
+                self.pool.publish(index, frame if frame is not buf else None, start)
 
     def isOpened(self):
         return self.stream.isOpened()
@@ -127,24 +356,34 @@ class PiVideoStream(VideoStream):
     VideoStream implementation for the Raspberry Pi camera
     '''
     def __init__(self, resolution=(320, 240), framerate=32):
-        from picamera.array import PiRGBArray
         from picamera import PiCamera
 
+        self.source = 'picamera'
         self.camera = PiCamera()
         self.camera.resolution = resolution
         self.camera.framerate = framerate
-        self.rawCapture = PiRGBArray(self.camera, size=resolution)
-        self.stream = self.camera.capture_continuous(self.rawCapture,
-            format="bgr", use_video_port=True)
+        # raw captures are padded to a multiple of 32 wide, 16 high
+        w, h = resolution
+        padded = ((h + 15) // 16 * 16, (w + 31) // 32 * 32, 3)
+        self.pool = FramePool(padded, size=(h, w))
         super().__init__()
+
+    def _outputs(self):
+        '''
+        Free pool buffers for capture_sequence to write into
+        '''
+        while not self.stopped:
+            index = self.pool.acquire()
+            start = time.time()
+            yield self.pool.buffers[index]
+            # capture_sequence asks for the next output once this one is full
+            self.pool.publish(index, start=start)
  
     def update(self):
-        for f in self.stream:
-            if self.stopped:
-                self.kill.set() # signal thread is ending
-                return
-            self.frame = f.array
-            self.rawCapture.truncate(0)
+        try:
+            self.camera.capture_sequence(self._outputs(), format="bgr", use_video_port=True)
+        finally:
+            self.kill.set() # signal thread is ending, even if the capture failed
 
     def isOpened(self):
         try:
@@ -154,6 +393,4 @@ class PiVideoStream(VideoStream):
             return False
 
     def _release(self):
-        self.stream.close()
-        self.rawCapture.close()
         self.camera.close()